@@ -0,0 +1,161 @@
+import argparse
+import numpy as np
+
+# imports of internal files
+import lockstep
+
+
+def erlang_b(load, capacity):
+    """
+    Erlang-B blocking probability of a link with capacity units offered load Erlangs of services of one unit each,
+    computed with the usual recursion. load can be an array, e.g., with the load offered to each link.
+    """
+    load = np.asarray(load, dtype=float)
+    blocking = np.ones_like(load)
+    for units in range(1, capacity + 1):
+        blocking = load * blocking / (units + load * blocking)
+    return blocking
+
+
+def kaufman_roberts(loads, units, capacity):
+    """
+    Blocking probability of each class of services on a link with capacity units, offered loads[..., c] Erlangs of
+    services of units[c] units each, computed with the Kaufman-Roberts recursion of the occupancy distribution.
+    loads has one row per link. Returns an array of the same shape as loads.
+    """
+    loads = np.asarray(loads, dtype=float)
+    occupancy = np.zeros(loads.shape[:-1] + (capacity + 1,))
+    occupancy[..., 0] = 1.0
+    for n in range(1, capacity + 1):
+        for c, units_c in enumerate(units):
+            if units_c <= n:
+                occupancy[..., n] += loads[..., c] * units_c * occupancy[..., n - units_c] / n
+        # the occupancy is rescaled before it overflows, as only its distribution matters
+        occupancy[..., :n + 1] /= np.maximum(occupancy[..., n:n + 1], 1.0)
+    occupancy /= occupancy.sum(axis=-1, keepdims=True)
+    return np.stack([occupancy[..., capacity - units_c + 1:].sum(axis=-1) for units_c in units], axis=-1)
+
+
+def get_pair_weights(env):
+    """
+    Fraction of the services of each ordered node pair (source index * N + destination index), following the traffic
+    matrix of env if set, or uniform over the distinct pairs as the traffic generators.
+    """
+    num_nodes = env.topology.number_of_nodes()
+    if env.traffic_matrix is not None:
+        weights = np.asarray(env.traffic_matrix, dtype=float) * ~np.eye(num_nodes, dtype=bool)
+    else:
+        weights = (~np.eye(num_nodes, dtype=bool)).astype(float)
+    return (weights / weights.sum()).ravel()
+
+
+def estimate_blocking(env, load=None, policy=None, iterations=1000, tolerance=1e-10):
+    """
+    Estimates the request blocking ratio of the configuration of env at the load (env.load by default) with the
+    policy ('SAP' or 'LB', the one of env by default), with the reduced-load (Erlang fixed-point) approximation over
+    the k shortest paths of env.topology: the links block independently, each one as an Erlang-B link
+    (Kaufman-Roberts with several numbers of units per service) offered the traffic that reaches it, i.e., the
+    traffic routed over its paths thinned by the blocking of the other links of each path. With SAP, the traffic of a
+    pair tries its paths in order, and with LB it is split among them in proportion to the probability of each one
+    being available divided by its number of hops, as the least loaded path tends to be a short one. A service is
+    blocked if none of its paths is available. The estimate is approximate, and is meant to find the loads with
+    negligible or saturated blocking, and to check the simulations.
+    """
+    load = env.load if load is None else load
+    policy = env.policy.name if policy is None else policy
+    if policy not in ['SAP', 'LB']:
+        raise ValueError('There is no estimate for the policy {}'.format(policy))
+    path_links, hops, exists = lockstep.get_path_tables(env.topology)
+    num_links = env.topology.number_of_edges()
+    capacity = env.resource_units_per_link
+    units, probabilities = env.units_distribution if env.units_distribution is not None else ([1], [1.])
+    # Erlangs of services offered by each pair, of each number of units
+    pair_loads = load * get_pair_weights(env)[:, None] * np.asarray(probabilities)[None, :]
+
+    # blocking of each link and number of units, where the last link is the dummy one used to pad the paths
+    link_blocking = np.zeros((num_links + 1, len(units)))
+    for _ in range(iterations):
+        link_available = np.maximum(1.0 - link_blocking, 1e-300)
+        # probability of each path being available (pairs x k x units)
+        path_available = link_available[path_links].prod(axis=2) * exists[:, :, None]
+        use = _get_path_use(path_available, hops, policy)
+        # the traffic routed over each path is offered to each of its links, thinned by the other links of the path
+        offered = (pair_loads[:, None, None, :] * use[:, :, None, :]) / link_available[path_links]
+        link_loads = np.stack([np.bincount(path_links.ravel(), weights=offered[..., c].ravel(),
+                                           minlength=num_links + 1) for c in range(len(units))], axis=1)
+        if units == [1]:
+            updated = erlang_b(link_loads, capacity)
+        else:
+            updated = kaufman_roberts(link_loads, units, capacity)
+        updated[num_links] = 0.0
+        converged = np.max(np.abs(updated - link_blocking)) < tolerance
+        # damped, as the plain iteration can oscillate at high loads
+        link_blocking = (link_blocking + updated) / 2
+        if converged:
+            break
+
+    path_available = (1.0 - link_blocking)[path_links].prod(axis=2) * exists[:, :, None]
+    pair_blocking = (1.0 - path_available).prod(axis=1)
+    return float((pair_loads * pair_blocking).sum() / load)
+
+
+def _get_path_use(path_available, hops, policy):
+    """
+    Probability that a service is routed over each of the k paths of its pair, given the probability of each path
+    being available (pairs x k x units) and the number of hops of each path (pairs x k).
+    """
+    if policy == 'SAP':
+        # the paths are tried in order: the j-th one is used if the previous ones are not available
+        previous_blocked = np.cumprod(np.concatenate([np.ones_like(path_available[:, :1]),
+                                                      1.0 - path_available[:, :-1]], axis=1), axis=1)
+        return previous_blocked * path_available
+    # LB: the services of the pair that find a path are spread among the available paths, less on the longer ones
+    weights = path_available / np.maximum(hops, 1)[:, :, None]
+    total = weights.sum(axis=1, keepdims=True)
+    accepted = 1.0 - (1.0 - path_available).prod(axis=1, keepdims=True)
+    return np.divide(accepted * weights, total, out=np.zeros_like(weights), where=total > 0)
+
+
+def estimate_loads(env, loads, policies):
+    """
+    Returns estimates[policy][load] with estimate_blocking() of each policy at each load.
+    """
+    return {policy: {load: estimate_blocking(env, load=load, policy=policy) for load in loads} for policy in policies}
+
+
+def get_simulated_loads(estimates, min_blocking, max_blocking):
+    """
+    Loads worth simulating given estimates[policy][load]: the ones at which the estimated blocking of some policy is
+    within [min_blocking, max_blocking], i.e., neither negligible nor saturated.
+    """
+    loads = list(next(iter(estimates.values())))
+    return [load for load in loads
+            if any(min_blocking <= per_load[load] <= max_blocking for per_load in estimates.values())]
+
+
+if __name__ == '__main__':
+    import core
+    import graph
+
+    parser = argparse.ArgumentParser(description='Estimates the request blocking ratio of each policy and load')
+    parser.add_argument('-tf', '--topology_file', default='nobel-us.xml', help='Network topology file to be used')
+    parser.add_argument('-k', '--k_paths', type=int, default=5, help='Number of k-shortest-paths (default=5)')
+    parser.add_argument('-kc', '--ksp_cache_folder', default='cache',
+                        help='Folder of the k-shortest-path cache, an empty value disables the cache (default=cache)')
+    parser.add_argument('-kw', '--ksp_weight', default=None,
+                        help='Link attribute used as weight in the k-shortest-path computation (default=None, i.e., hops)')
+    parser.add_argument('-ru', '--resource_units_per_link', type=int, default=80,
+                        help='Number of units of each link (default=80)')
+    parser.add_argument('-u', '--units', default=None,
+                        help='Distribution of the number of units per service, e.g., 1:0.6,2:0.3,4:0.1 (default: 1)')
+    parser.add_argument('-tm', '--traffic_matrix', default=None,
+                        help='File with the N x N matrix of relative traffic between nodes (default: uniform)')
+    parser.add_argument('--loads', type=float, nargs='+', default=[400, 550, 700, 850, 1000],
+                        help='Loads in Erlangs (default=400 550 700 850 1000)')
+    args = parser.parse_args()
+    args.rebuild_ksp_cache = False
+    args.traffic = 'numpy' if args.traffic_matrix is not None else 'python'
+    env = core.Environment(args, topology=graph.get_topology(args))
+    for policy, per_load in estimate_loads(env, args.loads, ['SAP', 'LB']).items():
+        for load, blocking in per_load.items():
+            print(f'{policy} load {load}: estimated blocking {blocking:.3e}')
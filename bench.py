@@ -0,0 +1,239 @@
+import logging
+logging.basicConfig(format='%(asctime)s\t%(name)-12s\t%(threadName)s\t%(message)s', level=logging.INFO)
+
+import argparse
+import datetime
+import json
+import platform
+import resource
+import sys
+import time
+import numpy as np
+
+# imports of internal files
+import core
+import events
+import graph
+import policies
+
+
+def get_peak_rss():
+    """
+    Peak resident set size of this process in MB (ru_maxrss is given in KB on Linux and in bytes on macOS).
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def get_measurement(unit, count, seconds):
+    return {
+        'unit': unit,
+        'count': count,
+        'seconds': seconds,
+        'per_second': count / seconds if seconds > 0 else float('inf'),
+        'us_each': 1e6 * seconds / count if count > 0 else float('nan'),
+        'peak_rss_mb': get_peak_rss(),
+    }
+
+
+def get_environment(args, topology, load, policy):
+    """
+    Environment with the settings used in the benchmarks: one seed, no progress plots and no service history.
+    """
+    env_args = argparse.Namespace(num_arrivals=args.num_arrivals, k_paths=topology.graph['k_paths'], num_seeds=1,
+                                  link_state=args.link_state, traffic=args.traffic, progress_plots='off',
+                                  service_history='off', output_folder='bench')
+    policy_instance = policies.ShortestAvailablePath() if policy == 'SAP' else policies.LoadBalancing()
+    env = core.Environment(env_args, topology=topology.copy(), load=load, policy=policy_instance, seed=2 * load)
+    env.results = {policy: {load: []}}
+    return env
+
+
+def bench_ksp(args, topology_file, k):
+    """
+    Times graph.get_topology(), i.e., reading the topology and computing its k shortest paths (the cache is not used).
+    """
+    topology_args = argparse.Namespace(topology_file=topology_file, k_paths=k, ksp_cache_folder=None, threads=1)
+    start = time.perf_counter()
+    topology = graph.get_topology(topology_args)
+    seconds = time.perf_counter() - start
+    topology.graph['k_paths'] = k
+    return topology, get_measurement('node pair', len(topology.graph['ksp']), seconds)
+
+
+def bench_setup_next_arrival(args, topology, load):
+    """
+    Times the generation of arrivals, which are added to the event queue but not processed.
+    """
+    env = get_environment(args, topology, load, 'SAP')
+    env.reset(seed=env.seed)
+    start = time.perf_counter()
+    for _ in range(args.num_arrivals):
+        env.setup_next_arrival()
+    return get_measurement('call', args.num_arrivals, time.perf_counter() - start)
+
+
+def bench_events(args, topology, load, policy):
+    """
+    Runs one simulation timing each event by its function, i.e., events.arrival (which includes routing and the
+    generation of the next arrival) and events.departure.
+    """
+    env = get_environment(args, topology, load, policy)
+    env.reset(seed=env.seed)
+    seconds = {call: 0.0 for call in env._event_calls}
+    counts = {call: 0 for call in env._event_calls}
+    while len(env.events) > 0:
+        call = env._event_calls[env.events[0][2]]
+        start = time.perf_counter()
+        env.process_next_event()
+        seconds[call] += time.perf_counter() - start
+        counts[call] += 1
+    return {call.__name__: get_measurement('event', counts[call], seconds[call]) for call in [events.arrival, events.departure]}
+
+
+def bench_route(args, topology, load, policy):
+    """
+    Times RoutingPolicy.route() on a network loaded by simulating half of the arrivals, routing random services
+    without provisioning them.
+    """
+    env = get_environment(args, topology, load, policy)
+    env.reset(seed=env.seed)
+    while len(env.events) > 0 and env._processed_arrivals < args.num_arrivals // 2:
+        env.process_next_event()
+    rng = np.random.default_rng(load)
+    nodes = topology.graph['node_indices']
+    services = []
+    for service_id in range(args.num_arrivals):
+        src_id, dst_id = rng.choice(len(nodes), size=2, replace=False).tolist()
+        services.append(core.Service(service_id, 0.0, 0.0, nodes[src_id], src_id, nodes[dst_id], dst_id))
+    start = time.perf_counter()
+    for service in services:
+        env.policy.route(service, env.topology.graph['ksp'][service.source, service.destination])
+    return get_measurement('call', len(services), time.perf_counter() - start)
+
+
+def bench_run_simulation(args, topology, load, policy):
+    """
+    Times core.run_simulation() with one seed. The events are the arrivals and departures processed.
+    """
+    env = get_environment(args, topology, load, policy)
+    start = time.perf_counter()
+    core.run_simulation(env)
+    seconds = time.perf_counter() - start
+    measurement = get_measurement('event', env._event_sequence, seconds)
+    measurement['request_blocking_ratio'] = env.results[policy][load][0]['request_blocking_ratio']
+    return measurement
+
+
+def run_benchmarks(args):
+    """
+    Runs all the benchmarks. Each one is repeated args.repeat times and the fastest repetition is kept.
+    Returns a dict with the measurements of each case, by case name.
+    """
+    cases = {}
+
+    def record(name, measurement):
+        cases[name] = measurement
+        logging.info(f'{name}: {measurement["us_each"]:.2f} us/{measurement["unit"]} '
+                     f'({measurement["per_second"]:.0f} {measurement["unit"]}s/s, '
+                     f'peak RSS {measurement["peak_rss_mb"]:.1f} MB)')
+
+    def add(name, function, *function_args):
+        best = None
+        for _ in range(args.repeat):
+            measurement = function(*function_args)
+            if best is None or measurement['seconds'] < best['seconds']:
+                best = measurement
+        record(name, best)
+
+    for topology_file in args.topologies:
+        for k in args.k_paths:
+            topology, measurement = bench_ksp(args, topology_file, k)
+            record(f'ksp/{topology_file}/k={k}', measurement)
+            for load in args.loads:
+                add(f'setup_next_arrival/{topology_file}/k={k}/load={load}', bench_setup_next_arrival, args,
+                    topology, load)
+                for policy in args.policies:
+                    prefix = f'{topology_file}/k={k}/load={load}/{policy}'
+                    event_measurements = bench_events(args, topology, load, policy)
+                    for call, measurement in event_measurements.items():
+                        record(f'{call}/{prefix}', measurement)
+                    add(f'route/{prefix}', bench_route, args, topology, load, policy)
+                    add(f'run_simulation/{prefix}', bench_run_simulation, args, topology, load, policy)
+    return cases
+
+
+def compare(cases, baseline, threshold):
+    """
+    Compares the time per operation of the cases with the ones of a baseline. Returns the list of (name, ratio) of
+    the cases slower than the baseline by more than threshold (e.g., 0.1 for 10%).
+    """
+    regressions = []
+    for name, measurement in sorted(cases.items()):
+        if name not in baseline['cases']:
+            continue
+        ratio = measurement['us_each'] / baseline['cases'][name]['us_each']
+        flag = ' REGRESSION' if ratio > 1 + threshold else ''
+        print(f'{name:<70} {baseline["cases"][name]["us_each"]:>12.2f} {measurement["us_each"]:>12.2f} {ratio:>7.2f}{flag}')
+        if ratio > 1 + threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    env = core.Environment()
+
+    parser = argparse.ArgumentParser(description='Benchmarks the hot paths of the simulator')
+    parser.add_argument('-tf', '--topologies', nargs='+', default=[env.topology_file, 'grid:8x8'],
+                        help='Topology files, or synthetic topologies given as grid:<rows>x<columns> '
+                             '(default={} grid:8x8)'.format(env.topology_file))
+    parser.add_argument('-k', '--k_paths', type=int, nargs='+', default=[2, env.k_paths],
+                        help='Numbers of k-shortest-paths (default=2 {})'.format(env.k_paths))
+    parser.add_argument('-l', '--loads', type=int, nargs='+', default=[400, 700, 1000],
+                        help='Loads in Erlangs (default=400 700 1000)')
+    parser.add_argument('-p', '--policies', nargs='+', default=['SAP', 'LB'], choices=['SAP', 'LB'],
+                        help='Routing policies (default=SAP LB)')
+    parser.add_argument('-a', '--num_arrivals', type=int, default=env.num_arrivals,
+                        help='Number of arrivals per simulation (default={})'.format(env.num_arrivals))
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Repetitions of each timing, of which the fastest is kept (default=1)')
+    parser.add_argument('-ls', '--link_state', default=env.link_state_mode, choices=['arrays', 'graph'],
+                        help='Storage of the link state (default={})'.format(env.link_state_mode))
+    parser.add_argument('-tg', '--traffic', default=env.traffic, choices=['python', 'numpy'],
+                        help='Generation of the arrivals (default={})'.format(env.traffic))
+    parser.add_argument('-o', '--output', default=None,
+                        help='JSON file where the measurements are written')
+    parser.add_argument('-c', '--compare', default=None,
+                        help='JSON file written by a previous run, to which the measurements are compared')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Slowdown with respect to --compare above which a case is a regression, '
+                             'in which case the exit code is 1 (default=0.1, i.e., 10%%)')
+    args = parser.parse_args()
+
+    cases = run_benchmarks(args)
+    try:
+        import git
+        commit = git.Repo().head.object.hexsha
+    except Exception:  # not in a git repository, or GitPython is not available
+        commit = None
+    output = {
+        'datetime': datetime.datetime.now().isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'args': vars(args),
+        'cases': cases,
+    }
+    if args.output is not None:
+        with open(args.output, 'wt') as file:
+            json.dump(output, file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, 'rt') as file:
+            baseline = json.load(file)
+        print(f'{"case":<70} {"baseline us":>12} {"current us":>12} {"ratio":>7}')
+        regressions = compare(cases, baseline, args.threshold)
+        if len(regressions) > 0:
+            print(f'{len(regressions)} case(s) slower by more than {args.threshold:.0%}')
+            sys.exit(1)
@@ -1,11 +1,17 @@
 import logging
+import os
+import pickle
 import random
 import heapq
 import multiprocessing
 import numpy as np
 
 import events
-import plots
+import graph
+import lockstep
+import profiling
+import stats
+import traffic
 from policies import ShortestAvailablePath
 
 
@@ -34,11 +40,42 @@ class Environment:
         else:
             self.num_seeds = 25
 
+        # sequential stopping: after min_seeds seeds, the seeds of a configuration stop when the half-width of the
+        # confidence interval of the request blocking ratio is within ci_precision times its mean (None disables it)
+        if args is not None and hasattr(args, "ci_precision"):
+            self.ci_precision = args.ci_precision
+        else:
+            self.ci_precision = None
+
+        if args is not None and hasattr(args, "min_seeds"):
+            self.min_seeds = args.min_seeds
+        else:
+            self.min_seeds = 5
+
+        if args is not None and hasattr(args, "confidence"):
+            self.confidence = args.confidence
+        else:
+            self.confidence = 0.95
+
         if args is not None and hasattr(args, "num_arrivals"):
             self.num_arrivals = args.num_arrivals
         else:
             self.num_arrivals = 10000
 
+        # statistics of the first warmup_arrivals arrivals are discarded, so that the empty network at the start of
+        # each simulation does not bias the results; the num_arrivals are counted after the warm-up
+        if args is not None and hasattr(args, "warmup_arrivals"):
+            self.warmup_arrivals = args.warmup_arrivals
+        else:
+            self.warmup_arrivals = 0
+
+        # batch means: the num_arrivals of each simulation are split into num_batches batches, and each batch is
+        # reported as one record with id_simulation = seed * num_batches + batch (0 reports one record per simulation)
+        if args is not None and hasattr(args, "num_batches"):
+            self.num_batches = args.num_batches
+        else:
+            self.num_batches = 0
+
         if args is not None and hasattr(args, "k_paths"):
             self.k_paths = args.k_paths
         else:
@@ -51,7 +88,7 @@ class Environment:
 
         if args is not None and hasattr(args, 'topology_file'):
             self.topology_file = args.topology_file
-            self.topology_name = args.topology_file.split('.')[0]
+            self.topology_name = graph.get_topology_name(args.topology_file)
         else:
             self.topology_file = "nobel-us.xml"#"nobel-us.xml" #"test-topo.xml"
             self.topology_name = 'nobel-us'
@@ -63,6 +100,80 @@ class Environment:
         else:
             self.resource_units_per_link = 80
 
+        # 'python' draws each arrival with random.Random, 'numpy' draws them in blocks with traffic.TrafficGenerator
+        if args is not None and hasattr(args, "traffic"):
+            self.traffic = args.traffic
+        else:
+            self.traffic = 'python'
+
+        # relative traffic between each pair of nodes (uniform if None), only supported by the 'numpy' traffic
+        if args is not None and getattr(args, "traffic_matrix", None) is not None:
+            self.traffic_matrix = traffic.load_traffic_matrix(args.traffic_matrix)
+            if self.traffic != 'numpy':
+                raise ValueError('A traffic matrix requires the numpy traffic generator')
+        else:
+            self.traffic_matrix = None
+
+        # distribution of the number of units requested by each service, e.g., '1:0.6,2:0.3,4:0.1' (None is always 1)
+        if args is not None and getattr(args, "units", None) is not None:
+            self.units_distribution = traffic.parse_units_distribution(args.units)
+        else:
+            self.units_distribution = None
+        self.traffic_generator = None
+
+        # 'arrays' keeps the link state in NumPy arrays indexed by the edge `index`; 'graph' uses the NetworkX attributes
+        if args is not None and hasattr(args, "link_state"):
+            self.link_state_mode = args.link_state
+        else:
+            self.link_state_mode = 'arrays'
+        self.link_state = None
+
+        # history of the services: 'memory' keeps all of them in the graph, 'disk' writes them to a CSV file per
+        # simulation, and 'off' keeps only the running services, so that the memory does not grow with the arrivals
+        if args is not None and hasattr(args, "service_history"):
+            self.service_history = args.service_history
+        else:
+            self.service_history = 'memory'
+        self._history_file = None
+
+        # common random numbers: the simulations of all the policies with the same load and seed are run together
+        # over one trace of arrivals (see run_common_simulation)
+        if args is not None and hasattr(args, "common_random_numbers"):
+            self.common_random_numbers = args.common_random_numbers
+        else:
+            self.common_random_numbers = False
+
+        # load sweep: the simulations of all the loads with the same seed are run together over one trace of arrivals,
+        # whose inter-arrival times are scaled to each load (see run_common_simulation)
+        if args is not None and hasattr(args, "load_sweep"):
+            self.load_sweep = args.load_sweep
+        else:
+            self.load_sweep = False
+
+        # 'events' runs each simulation with its event queue, and 'lockstep' runs the seeds of a task together, with
+        # the link state of all of them in NumPy arrays (see lockstep.py)
+        if args is not None and hasattr(args, "engine"):
+            self.engine = args.engine
+            if self.engine == 'lockstep' and (self.service_history != 'off' or self.common_random_numbers or
+                                              self.load_sweep or getattr(args, "profile", False)):
+                raise ValueError('The lockstep engine requires --service_history off, and does not support common '
+                                 'random numbers, load sweeps or profiling')
+        else:
+            self.engine = 'events'
+
+        # if set, the state of each simulation is saved every snapshot_every arrivals, so that run_simulation() can
+        # resume it from the last snapshot (see save_snapshot)
+        if args is not None and getattr(args, "snapshot_every", None):
+            self.snapshot_every = args.snapshot_every
+            if self.service_history == 'disk':
+                raise ValueError('Snapshots are not supported with the service history on disk')
+            if self.engine == 'lockstep':
+                raise ValueError('Snapshots are not supported with the lockstep engine')
+            if self.common_random_numbers or self.load_sweep:
+                raise ValueError('Snapshots are not supported with common random numbers or load sweeps')
+        else:
+            self.snapshot_every = None
+
         if policy is not None:
             self.policy = policy # parameter has precedence over argument
             self.policy.env = self
@@ -70,8 +181,9 @@ class Environment:
             self.policy = ShortestAvailablePath() # shortest path by default
             self.policy.env = self
 
+        self.topology = None
         if topology is not None:
-            self.topology = topology
+            self.set_topology(topology)
 
         if seed is not None:
             self.seed = seed
@@ -84,6 +196,7 @@ class Environment:
             self.results = results
         else:
             self.results = [] # initiates with an empty local results vector
+        self.results_queue = None # if set, the results of each seed are sent through it instead of added to results
 
         if id_simulation is not None:
             self.id_simulation = id_simulation
@@ -92,16 +205,34 @@ class Environment:
 
         self.track_stats_every = 100 # frequency at which results are saved
         self.plot_tracked_stats_every = 1000 # frequency at which results are plotted
-        self.tracked_results = {}
         self.tracked_statistics = ['request_blocking_ratio', 'average_link_usage']
-        for obs in self.tracked_statistics:
-            self.tracked_results[obs] = []
-
-        self.events = []  # event queue
+        # the tracked statistics are written into preallocated arrays, see the property tracked_results
+        self._tracked_arrays = {obs: np.zeros(0) for obs in self.tracked_statistics}
+        self._tracked_samples = 0
+
+        # network-wide aggregates, updated at each provisioning and release (see _update_network_stats)
+        self._used_units = 0  # units in use summed over all links
+        self._total_units = 0  # units summed over all links
+        self._usage_integral = 0.0  # time integral of self._used_units
+        self._last_network_update = 0.0
+
+        self.events = []  # event queue, with tuples (time, sequence number, event kind, service id)
+        self._event_sequence = 0  # breaks ties between events with the same time in the order they were added
+        self._event_calls = [events.arrival, events.departure]  # event kind -> function called
+        self._event_kinds = {call: kind for kind, call in enumerate(self._event_calls)}
+        self.services = {}  # services with pending events, by service id
         self._processed_arrivals = 0
         self._rejected_services = 0
         self.current_time = 0.0
 
+        # the statistics are computed from the time and counters at their last restart (end of warm-up or batch)
+        self._stats_start_time = 0.0
+        self._stats_start_arrivals = 0
+        self._stats_start_rejected = 0
+        self._next_restart_arrival = -1  # number of arrivals at which the warm-up or the current batch ends
+        self._batch = 0
+        self._simulation_records = []  # records reported by the current simulation
+
         if output_folder is not None:
             self.output_folder = output_folder
         elif args is not None and hasattr(args, "output_folder"):
@@ -111,71 +242,247 @@ class Environment:
 
         self.plot_formats = ['pdf'] # you can configure this to other formats such as PNG, SVG
 
+        # 'sync' plots the progress within the simulation, 'async' sends the tracked statistics to a plotting process
+        # through plot_queue, and 'off' only keeps them in the results (see plots.py to plot them afterwards)
+        if args is not None and hasattr(args, "progress_plots"):
+            self.progress_plots = args.progress_plots
+        else:
+            self.progress_plots = 'sync'
+        self.plot_queue = None
+
+        # if set, run_simulation() measures the time spent in each kind of event, routing, statistics and plots
+        if args is not None and hasattr(args, "profile"):
+            self.profile = args.profile
+            if self.profile and (self.common_random_numbers or self.load_sweep):
+                raise ValueError('Profiling is not supported with common random numbers or load sweeps')
+            if self.profile and self.snapshot_every:
+                raise ValueError('Profiling is not supported with snapshots')
+        else:
+            self.profile = False
+
+    def set_topology(self, topology):
+        self.topology = topology
+        self._nodes = list(topology.nodes())
+        self._node_index = {node: idx for idx, node in enumerate(topology.graph['node_indices'])}
+        if self.link_state_mode == 'arrays':
+            self.link_state = LinkState(topology.number_of_edges())
+        # edge indices in the order of topology.edges(), in which the individual link statistics are reported
+        self._edge_order = np.array([idx for _, _, idx in topology.edges(data='index')], dtype=int)
+
+    @property
+    def tracked_results(self):
+        """
+        Statistics tracked every track_stats_every arrivals in the current simulation, as a dict of arrays.
+        """
+        return {obs: values[:self._tracked_samples] for obs, values in self._tracked_arrays.items()}
+
     def compute_simulation_stats(self):
         # run here the code to summarize statistics from this specific run
-        plots.plot_simulation_progress(self)
+        self._close_history_file()
+        self.sync_topology()
+        self.plot_progress()
+        if self.num_batches == 0:  # otherwise, the records were sent at the end of each batch
+            self._send_record(self.get_simulation_record())
+
+    def get_simulation_record(self, id_simulation=None, tracked_results=True):
+        """
+        Returns the record with the statistics of this simulation (or of the current batch) since their last restart.
+        """
         # add here the code to include other statistics you may want
-        self.results[self.policy.name][self.load].append({
+        if self.link_state is not None:
+            individual_link_usage = self.link_state.utilization[self._edge_order].tolist()
+        else:
+            individual_link_usage = [self.topology[n1][n2]['utilization'] for n1, n2 in self.topology.edges()]
+        return {
+            'policy': self.policy.name,
+            'load': self.load,
+            'id_simulation': self.id_simulation if id_simulation is None else id_simulation,
+            'seed': self.seed,
             'request_blocking_ratio': self.get_request_blocking_ratio(),
-            'average_link_usage': np.mean([self.topology[n1][n2]['utilization'] for n1, n2 in self.topology.edges()]),
-            'individual_link_usage': [self.topology[n1][n2]['utilization'] for n1, n2 in self.topology.edges()]
-        })
+            'average_link_usage': np.mean(individual_link_usage),
+            'individual_link_usage': individual_link_usage,
+            'network_utilization': self.get_network_utilization(),
+            'tracked_results': {obs: values.tolist() for obs, values in self.tracked_results.items()}
+            if tracked_results else {}
+        }
+
+    def _send_record(self, record):
+        self._simulation_records.append(record)
+        if self.results_queue is not None:
+            self.results_queue.put(record)
+        else:
+            self.results[self.policy.name][self.load].append(record)
 
-    def reset(self, seed=None, id_simulation=None):
+    def get_progress_record(self):
+        """
+        Returns the information needed to plot the progress of this simulation (see plots.plot_progress_record).
+        """
+        return {
+            'policy': self.policy.name,
+            'load': self.load,
+            'id_simulation': self.id_simulation,
+            'track_stats_every': self.track_stats_every,
+            'tracked_results': {obs: values.tolist() for obs, values in self.tracked_results.items()},
+            'output_folder': self.output_folder,
+            'plot_formats': self.plot_formats
+        }
+
+    def plot_progress(self):
+        if self.progress_plots == 'sync':
+            import plots  # matplotlib is only imported by the processes that plot
+            plots.plot_simulation_progress(self)
+        elif self.progress_plots == 'async' and self.plot_queue is not None:
+            self.plot_queue.put(self.get_progress_record())
+
+    def reset(self, seed=None, id_simulation=None, traffic_generator=None):
+        """
+        Starts a new simulation. The arrivals are drawn by a new generator for the seed (see get_traffic_generator),
+        unless traffic_generator is given, e.g., a traffic.TraceReader replaying the arrivals of another simulation.
+        """
         self.events = [] # event queue
+        self._event_sequence = 0
+        self.services = {}
         self._processed_arrivals = 0
         self._rejected_services = 0
         self.current_time = 0.0
+        self._stats_start_time = 0.0
+        self._stats_start_arrivals = 0
+        self._stats_start_rejected = 0
+        self._batch = 0
+        self._simulation_records = []
+        if self.warmup_arrivals > 0:
+            self._next_restart_arrival = self.warmup_arrivals
+        elif self.num_batches > 0:
+            self._next_restart_arrival = self._get_batch_end(0)
+        else:
+            self._next_restart_arrival = -1
 
+        self._tracked_samples = 0
+        # arrivals are counted up to warmup_arrivals + num_arrivals + 1
+        num_samples = (self.warmup_arrivals + self.num_arrivals + 1) // self.track_stats_every
         for obs in self.tracked_statistics:
-            self.tracked_results[obs] = []
+            if len(self._tracked_arrays[obs]) != num_samples:
+                self._tracked_arrays[obs] = np.zeros(num_samples)
+
+        self._used_units = 0
+        self._total_units = self.resource_units_per_link * self.topology.number_of_edges()
+        self._usage_integral = 0.0
+        self._last_network_update = 0.0
 
         if seed is not None:
             self.seed = seed
             self.rng = random.Random(seed)
         if id_simulation is not None:
             self.id_simulation = id_simulation
+        self.traffic_generator = traffic_generator if traffic_generator is not None else self.get_traffic_generator()
 
         # (re)-initialize the graph
-        self.topology.graph['running_services'] = []
+        # running services are kept in dicts by service id, and services holds the history ('memory' mode only)
+        self.topology.graph['running_services'] = {}
         self.topology.graph['services'] = []
         for idx, lnk in enumerate(self.topology.edges()):
             link = self.topology[lnk[0]][lnk[1]]
             link['available_units'] = self.resource_units_per_link
             link['total_units'] = self.resource_units_per_link
             link['services'] = []
-            link['running_services'] = []
+            link['running_services'] = {}
             link['id'] = idx
             link['utilization'] = 0.0
             link['last_update'] = 0.0
+        if self.link_state is not None:
+            self.link_state.reset(self.resource_units_per_link)
+        if self.service_history == 'disk':
+            self._open_history_file()
         self.setup_next_arrival()
         
+    def get_traffic_generator(self, seed=None):
+        """
+        Returns a new generator of the arrivals of the seed (by default, the current one): traffic.TrafficGenerator
+        with the 'numpy' traffic, or traffic.PythonTrafficGenerator with the 'python' traffic, which draws from
+        self.rng unless a seed is given.
+        """
+        if self.traffic == 'numpy':
+            units, unit_probabilities = self.units_distribution if self.units_distribution is not None else (None, None)
+            return traffic.TrafficGenerator(self.topology.number_of_nodes(), self.seed if seed is None else seed,
+                                            self.mean_service_inter_arrival_time, self.mean_service_holding_time,
+                                            traffic_matrix=self.traffic_matrix, units=units,
+                                            unit_probabilities=unit_probabilities)
+        rng = self.rng if seed is None else random.Random(seed)
+        return traffic.PythonTrafficGenerator(rng, self._nodes, self._node_index,
+                                              self.mean_service_inter_arrival_time,
+                                              self.mean_service_holding_time,
+                                              units_distribution=self.units_distribution)
+
     def setup_next_arrival(self):
         """
         Returns the next arrival to be scheduled in the simulator
         """
-        if self._processed_arrivals > self.num_arrivals:
+        if self._processed_arrivals == self._next_restart_arrival:
+            self._end_period()
+        if self._processed_arrivals > self.warmup_arrivals + self.num_arrivals:
             return None # returns None when all arrivals have been processed
-        at = self.current_time + self.rng.expovariate(1 / self.mean_service_inter_arrival_time)
-
-        ht = self.rng.expovariate(1 / self.mean_service_holding_time)
-        dst = src = self.rng.choice([x for x in self.topology.nodes()])
-        while src == dst:
-            dst = self.rng.choice([x for x in self.topology.nodes()])
-        src_id = self.topology.graph['node_indices'].index(src)
-        dst_id = self.topology.graph['node_indices'].index(dst)
+        inter_arrival_time, ht, src_id, dst_id, number_units = self.traffic_generator.next()
+        at = self.current_time + inter_arrival_time
+        src = self.topology.graph['node_indices'][src_id]
+        dst = self.topology.graph['node_indices'][dst_id]
 
         self._processed_arrivals += 1
 
         if self._processed_arrivals % self.track_stats_every == 0:
-            self.tracked_results['request_blocking_ratio'].append(self.get_request_blocking_ratio())
-            self.tracked_results['average_link_usage'].append(np.mean([(self.topology[n1][n2]['total_units'] - self.topology[n1][n2]['available_units']) / self.topology[n1][n2]['total_units'] for n1, n2 in self.topology.edges()]))
+            self._tracked_arrays['request_blocking_ratio'][self._tracked_samples] = self.get_request_blocking_ratio()
+            # all links have the same number of units, thus the average link usage is the network-wide occupancy
+            self._tracked_arrays['average_link_usage'][self._tracked_samples] = self._used_units / self._total_units
+            self._tracked_samples += 1
         if self._processed_arrivals % self.plot_tracked_stats_every == 0:
-            plots.plot_simulation_progress(self)
+            self.plot_progress()
+
+        next_arrival = Service(self._processed_arrivals, at, ht, src, src_id, dst, dst_id, number_units=number_units)
+        self.schedule(next_arrival.arrival_time, events.arrival, next_arrival)
+
+    def _get_batch_end(self, batch):
+        """
+        Number of processed arrivals at which the batch ends. The last batch also takes the remaining arrivals.
+        """
+        if batch == self.num_batches - 1:
+            return self.warmup_arrivals + self.num_arrivals
+        return self.warmup_arrivals + (batch + 1) * (self.num_arrivals // self.num_batches)
+
+    def _end_period(self):
+        """
+        Ends the warm-up or the current batch: the record of the batch is sent, and the statistics are restarted.
+        """
+        if self._processed_arrivals > self.warmup_arrivals:
+            # brings the statistics of the links not used recently up to the current time
+            if self.link_state is not None:
+                self.link_state.update_stats(self._edge_order, self.current_time, self.resource_units_per_link)
+            else:
+                for n1, n2 in self.topology.edges():
+                    self._update_link_stats(n1, n2)
+            last_batch = self._batch == self.num_batches - 1
+            self._send_record(self.get_simulation_record(id_simulation=self.id_simulation * self.num_batches + self._batch,
+                                                         tracked_results=last_batch))
+            self._batch += 1
+        self._restart_statistics()
+        if self.num_batches > 0 and self._batch < self.num_batches:
+            self._next_restart_arrival = self._get_batch_end(self._batch)
+        else:
+            self._next_restart_arrival = -1
 
-        #TODO: number of units necessary can also be randomly selected, now it's always one
-        next_arrival = Service(self._processed_arrivals, at, ht, src, src_id, dst, dst_id, number_units=1)
-        self.add_event(Event(next_arrival.arrival_time, events.arrival, next_arrival))
+    def _restart_statistics(self):
+        """
+        Discards the statistics collected so far, keeping the state of the network.
+        """
+        self._stats_start_time = self.current_time
+        self._stats_start_arrivals = self._processed_arrivals
+        self._stats_start_rejected = self._rejected_services
+        self._usage_integral = 0.0
+        self._last_network_update = self.current_time
+        if self.link_state is not None:
+            self.link_state.restart(self.current_time)
+        else:
+            for n1, n2 in self.topology.edges():
+                self.topology[n1][n2]['utilization'] = 0.0
+                self.topology[n1][n2]['last_update'] = self.current_time
 
     def set_load(self, load=None, mean_service_holding_time=None):
         if load is not None:
@@ -192,33 +499,126 @@ class Environment:
         :return: None
         """
         #self.debug("time={}; event={}".format(event.time, event.call))
-        heapq.heappush(self.events, (event.time, event))
+        self.schedule(event.time, event.call, event.params)
+
+    def schedule(self, time, call, service):
+        """
+        Adds to the event queue a call to the function call(env, service) at the given time, without creating an
+        Event object. The queue only stores the service id, and the service is kept in self.services until it is
+        rejected or released.
+        """
+        kind = self._event_kinds.get(call)
+        if kind is None:  # functions other than arrival and departure
+            kind = self._event_kinds[call] = len(self._event_calls)
+            self._event_calls.append(call)
+        self.services[service.service_id] = service
+        heapq.heappush(self.events, (time, self._event_sequence, kind, service.service_id))
+        self._event_sequence += 1
+
+    def process_next_event(self):
+        """
+        Removes the next event from the queue, advances the clock and calls the event function.
+        """
+        time, _, kind, service_id = heapq.heappop(self.events)
+        self.current_time = time
+        self._event_calls[kind](self, self.services[service_id])
 
     def provision_path(self, service):
         # provisioning the path
+        if self.link_state is not None:
+            self.link_state.allocate(service.route.edge_indices, service.number_units)
+            self.link_state.update_stats(service.route.edge_indices, self.current_time, self.resource_units_per_link)
+            service.provisioned = True
+            self.topology.graph['running_services'][service.service_id] = service
+            self._record_service(service)
+            self._update_network_stats(service.number_units * service.route.hops)
+            self.schedule(service.arrival_time + service.holding_time, events.departure, service)
+            return
         for i in range(len(service.route.node_list) - 1):
             self.topology[service.route.node_list[i]][service.route.node_list[i + 1]]['available_units'] -= service.number_units
-            self.topology[service.route.node_list[i]][service.route.node_list[i + 1]]['services'].append(service)
-            self.topology[service.route.node_list[i]][service.route.node_list[i + 1]]['running_services'].append(service)
+            if self.service_history == 'memory':
+                self.topology[service.route.node_list[i]][service.route.node_list[i + 1]]['services'].append(service)
+            self.topology[service.route.node_list[i]][service.route.node_list[i + 1]]['running_services'][service.service_id] = service
             self._update_link_stats(service.route.node_list[i], service.route.node_list[i + 1])
         service.provisioned = True
-        self.topology.graph['running_services'].append(service)
-        self._update_network_stats()
+        self.topology.graph['running_services'][service.service_id] = service
+        self._record_service(service)
+        self._update_network_stats(service.number_units * service.route.hops)
 
         # schedule departure
-        self.add_event(Event(service.arrival_time + service.holding_time, events.departure, service))
+        self.schedule(service.arrival_time + service.holding_time, events.departure, service)
 
     def reject_service(self, service):
         service.provisioned = False
-        self.topology.graph['services'].append(service)
+        del self.services[service.service_id]
+        self._record_service(service)
         self._rejected_services += 1
 
     def release_path(self, service):
+        del self.services[service.service_id]
+        del self.topology.graph['running_services'][service.service_id]
+        if self.link_state is not None:
+            self.link_state.release(service.route.edge_indices, service.number_units)
+            self.link_state.update_stats(service.route.edge_indices, self.current_time, self.resource_units_per_link)
+            self._update_network_stats(-service.number_units * service.route.hops)
+            return
         for i in range(len(service.route.node_list) - 1):
             self.topology[service.route.node_list[i]][service.route.node_list[i + 1]]['available_units'] += service.number_units
-            self.topology[service.route.node_list[i]][service.route.node_list[i + 1]]['running_services'].remove(service)
+            del self.topology[service.route.node_list[i]][service.route.node_list[i + 1]]['running_services'][service.service_id]
             self._update_link_stats(service.route.node_list[i], service.route.node_list[i + 1])
-        self._update_network_stats()
+        self._update_network_stats(-service.number_units * service.route.hops)
+
+    def _record_service(self, service):
+        """
+        Adds a service to the history once it is provisioned or rejected, according to self.service_history.
+        """
+        if self.service_history == 'memory':
+            self.topology.graph['services'].append(service)
+        elif self.service_history == 'disk':
+            route = '|'.join(service.route.node_list) if service.provisioned else ''
+            self._history_file.write(f'{service.service_id},{service.arrival_time},{service.holding_time},'
+                                     f'{service.source},{service.destination},{service.number_units},'
+                                     f'{int(service.provisioned)},{route}\n')
+
+    def get_snapshot_file(self):
+        return './results/{}/units/{}_{}_{}.snapshot'.format(self.output_folder, self.policy.name, self.load,
+                                                            self.id_simulation)
+
+    def save_snapshot(self, file):
+        """
+        Saves the state of the current simulation (clock, event queue, services, link state, random generators and
+        statistics) between two events. The file is written under a temporary name and then renamed.
+        """
+        state = {key: value for key, value in self.__dict__.items() if key not in _SNAPSHOT_EXCLUDED}
+        state['graph'] = {key: self.topology.graph[key] for key in ['running_services', 'services']}
+        state['links'] = {(n1, n2): {key: link[key] for key in _SNAPSHOT_LINK_KEYS}
+                          for n1, n2, link in self.topology.edges(data=True)}
+        with open(file + '.tmp', 'wb') as output:
+            pickle.dump(state, output)
+        os.replace(file + '.tmp', file)
+
+    def load_snapshot(self, file):
+        """
+        Restores the state saved by save_snapshot() into an environment with the same configuration.
+        """
+        with open(file, 'rb') as data:
+            state = pickle.load(data)
+        self.topology.graph.update(state.pop('graph'))
+        for (n1, n2), link in state.pop('links').items():
+            self.topology[n1][n2].update(link)
+        self.__dict__.update(state)
+
+    def _open_history_file(self):
+        self._close_history_file()
+        self._history_file = open('./results/{}/services_{}_{}_{}.csv'.format(self.output_folder, self.policy.name,
+                                                                               self.load, self.id_simulation), 'wt')
+        self._history_file.write('service_id,arrival_time,holding_time,source,destination,number_units,'
+                                 'provisioned,route\n')
+
+    def _close_history_file(self):
+        if self._history_file is not None:
+            self._history_file.close()
+            self._history_file = None
 
     def _update_link_stats(self, node1, node2):
         """
@@ -226,51 +626,351 @@ class Environment:
         """
         last_update = self.topology[node1][node2]['last_update']
         time_diff = self.current_time - self.topology[node1][node2]['last_update']
-        if self.current_time > 0:
+        if self.current_time > self._stats_start_time:
             last_util = self.topology[node1][node2]['utilization']
             cur_util = (self.resource_units_per_link - self.topology[node1][node2]['available_units']) / self.resource_units_per_link
             # utilization is weighted by the time
-            utilization = ((last_util * last_update) + (cur_util * time_diff)) / self.current_time
+            utilization = ((last_util * (last_update - self._stats_start_time)) + (cur_util * time_diff)) / \
+                          (self.current_time - self._stats_start_time)
             self.topology[node1][node2]['utilization'] = utilization
         self.topology[node1][node2]['last_update'] = self.current_time
 
-    def _update_network_stats(self):
+    def _update_network_stats(self, used_units_change=0):
         """
-        Updates statistics related to the entire network. To be implemented using the particular stats necessary for your problem.
+        Updates statistics related to the entire network, in O(1): the units in use over all links and their time
+        integral. Add here other stats necessary for your problem.
         """
-        pass
+        self._usage_integral += self._used_units * (self.current_time - self._last_network_update)
+        self._last_network_update = self.current_time
+        self._used_units += used_units_change
+
+    def get_network_utilization(self):
+        """
+        Time-weighted utilization of the network, i.e., the average over time of the fraction of units in use.
+        """
+        if self.current_time <= self._stats_start_time:
+            return 0.0
+        usage_integral = self._usage_integral + self._used_units * (self.current_time - self._last_network_update)
+        return usage_integral / ((self.current_time - self._stats_start_time) * self._total_units)
 
     def get_request_blocking_ratio(self):
-        return float(self._rejected_services) / float(self._processed_arrivals)
+        return float(self._rejected_services - self._stats_start_rejected) / \
+            float(self._processed_arrivals - self._stats_start_arrivals)
+
+    def sync_topology(self):
+        """
+        Copies the link-state arrays back into the NetworkX graph, so that it can be used for plotting and by code
+        that reads the link attributes directly. The per-link services are rebuilt from the running services and,
+        in 'memory' history mode, from the history.
+        """
+        if self.link_state is None:
+            return
+        for n1, n2, idx in self.topology.edges(data='index'):
+            link = self.topology[n1][n2]
+            link['available_units'] = int(self.link_state.available_units[idx])
+            link['total_units'] = int(self.link_state.total_units[idx])
+            link['utilization'] = float(self.link_state.utilization[idx])
+            link['last_update'] = float(self.link_state.last_update[idx])
+            link['services'] = []
+            link['running_services'] = {}
+        for service in self.topology.graph['running_services'].values():
+            for i in range(len(service.route.node_list) - 1):
+                self.topology[service.route.node_list[i]][service.route.node_list[i + 1]]['running_services'][service.service_id] = service
+        for service in self.topology.graph['services']:
+            if service.provisioned:
+                for i in range(len(service.route.node_list) - 1):
+                    self.topology[service.route.node_list[i]][service.route.node_list[i + 1]]['services'].append(service)
+
+
+# attributes of the environment that are part of its configuration or cannot be pickled, and are not in snapshots
+_SNAPSHOT_EXCLUDED = ['topology', 'policy', 'results', 'results_queue', 'plot_queue', '_history_file', '_nodes',
+                      '_node_index', '_edge_order']
+# link attributes saved in snapshots
+_SNAPSHOT_LINK_KEYS = ['available_units', 'total_units', 'services', 'running_services', 'utilization', 'last_update']
+
+
+class LinkState:
+    """
+    Stores the state of the links in NumPy arrays indexed by the edge attribute `index`.
+    Paths are checked, allocated and released using their `edge_indices` in a vectorized way.
+    """
+    def __init__(self, num_links):
+        self.available_units = np.zeros(num_links, dtype=int)
+        self.total_units = np.zeros(num_links, dtype=int)
+        self.utilization = np.zeros(num_links, dtype=float)
+        self.last_update = np.zeros(num_links, dtype=float)
+        self.start_time = 0.0  # time at which the statistics were (re)started
+
+    def reset(self, units):
+        self.available_units[:] = units
+        self.total_units[:] = units
+        self.utilization[:] = 0.0
+        self.last_update[:] = 0.0
+        self.start_time = 0.0
+
+    def restart(self, current_time):
+        """
+        Discards the link statistics collected until current_time.
+        """
+        self.utilization[:] = 0.0
+        self.last_update[:] = current_time
+        self.start_time = current_time
+
+    def is_path_free(self, path, number_units):
+        return bool(np.all(self.available_units[path.edge_indices] >= number_units))
+
+    def get_max_usage(self, path):
+        return np.max(self.total_units[path.edge_indices] - self.available_units[path.edge_indices])
+
+    def evaluate_paths(self, path_links, number_units, max_usage=True):
+        """
+        Evaluates all the candidate paths of a node pair at once using their k x H link table (see
+        graph.get_path_links). Returns a boolean array with the feasibility of each path and an array with their
+        maximum link usage (None if max_usage is False).
+        """
+        available = self.available_units[path_links]
+        feasible = (available >= number_units).all(axis=1)
+        if not max_usage:
+            return feasible, None
+        return feasible, (self.total_units[path_links] - available).max(axis=1)
+
+    def get_usage(self):
+        return (self.total_units - self.available_units) / self.total_units
+
+    def allocate(self, edge_indices, number_units):
+        self.available_units[edge_indices] -= number_units
+
+    def release(self, edge_indices, number_units):
+        self.available_units[edge_indices] += number_units
+
+    def update_stats(self, edge_indices, current_time, resource_units_per_link):
+        """
+        Updates link statistics following a time-weighted manner, for the links in edge_indices.
+        """
+        last_update = self.last_update[edge_indices]
+        if current_time > self.start_time:
+            cur_util = (resource_units_per_link - self.available_units[edge_indices]) / resource_units_per_link
+            # utilization is weighted by the time
+            self.utilization[edge_indices] = ((self.utilization[edge_indices] * (last_update - self.start_time)) +
+                                              (cur_util * (current_time - last_update))) / \
+                                             (current_time - self.start_time)
+        self.last_update[edge_indices] = current_time
+
+
+# topology attached from the shared memory by each process of the pool
+_worker_topology = None
+# queues to the plotting process and to the process collecting the results, if any
+_worker_plot_queue = None
+_worker_results_queue = None
+
+
+def init_worker(shared_topology, plot_queue=None, results_queue=None):
+    """
+    Initializer of the processes of the pool: attaches the immutable part of the topology (paths and link
+    tables) from shared memory once per process.
+    """
+    global _worker_topology, _worker_plot_queue, _worker_results_queue
+    _worker_topology = shared_topology.attach()
+    _worker_plot_queue = plot_queue
+    _worker_results_queue = results_queue
 
 
-def run_simulation(env):
+def get_simulation_seed(base_seed, id_simulation):
+    """
+    Seed of the id_simulation-th simulation of a configuration. The seeds were originally obtained by adding the
+    simulation number to the seed of the previous simulation, i.e., base_seed + 0 + 1 + ... + id_simulation, which is
+    kept so that each simulation can run independently with the same results.
+    """
+    return base_seed + id_simulation * (id_simulation + 1) // 2
+
+
+def run_simulation(env, seeds=None):
     """
     Launches the simulation for one particular configuration represented by the env object.
+    By default all the env.num_seeds seeds are run, otherwise only the ones in seeds. If env.ci_precision is set, the
+    seeds stop as soon as the confidence interval of the request blocking ratio (over the seeds, or over the batches
+    if env.num_batches is set) is narrow enough.
+    If the env has no topology, it receives a copy of the topology attached by init_worker(). Only the link attributes
+    are copied, while the paths are shared by all the simulations of the process.
+    If env.snapshot_every is set, each simulation is resumed from its snapshot, if any, and its snapshot is removed
+    once it finishes.
+    With env.engine set to 'lockstep', the seeds are run together by lockstep.LockstepSimulation, with the same
+    records, and without progress plots.
+    Returns the profile of the simulations if env.profile is set (see profiling.SimulationProfiler), otherwise None.
     """
-    logger = multiprocessing.log_to_stderr()
-    logger.setLevel(logging.INFO)
+    _attach_worker(env)
+    logger = _get_worker_logger()
     logger.info(f'Running simulation for load {env.load} and policy {env.policy.name}')
 
-    for seed in range(env.num_seeds):
-        env.reset(seed=env.seed + seed, id_simulation=seed) # adds to the general seed
+    if seeds is None:
+        seeds = range(env.num_seeds)
+    # env.seed is kept as the base seed, as reset() overwrites it with the seed of each simulation
+    base_seed = env.seed
+    if env.engine == 'lockstep':
+        logger.info(f'Running simulations {list(seeds)} in lockstep for policy {env.policy.name} and load {env.load}')
+        lockstep.LockstepSimulation(env, [(seed, get_simulation_seed(base_seed, seed)) for seed in seeds]).run()
+        logger.info(f'Finishing simulation for load {env.load} and policy {env.policy.name}')
+        return None
+    blocking_ratios = []
+    profiler = profiling.SimulationProfiler(env) if env.profile else None
+    for seed in seeds:
+        if env.ci_precision is not None and \
+                stats.has_converged(blocking_ratios, env.ci_precision, env.min_seeds, env.confidence):
+            logger.info(f'Stopping after {len(blocking_ratios)} seeds for policy {env.policy.name} and load {env.load}')
+            break
+        env.reset(seed=get_simulation_seed(base_seed, seed), id_simulation=seed) # adds to the general seed
         logger.info(f'Running simulation {seed} for policy {env.policy.name} and load {env.load}')
-        while len(env.events) > 0:
-            event_tuple = heapq.heappop(env.events)
-            time = event_tuple[0]
-            env.current_time = time
-            event = event_tuple[1]
-            event.call(env, event.params)
-
-        env.compute_simulation_stats()
+        snapshot_file = env.get_snapshot_file() if env.snapshot_every else None
+        if snapshot_file is not None and os.path.isfile(snapshot_file):
+            env.load_snapshot(snapshot_file)
+            logger.info(f'Resuming simulation {seed} for policy {env.policy.name} and load {env.load} '
+                        f'after {env._processed_arrivals} arrivals')
+            # the records of the batches before the snapshot are sent again, as they may not have been saved
+            restored_records, env._simulation_records = env._simulation_records, []
+            for record in restored_records:
+                env._send_record(record)
+        if profiler is not None:
+            profiler.run()
+        elif snapshot_file is not None:
+            next_snapshot = env._processed_arrivals + env.snapshot_every
+            while len(env.events) > 0:
+                env.process_next_event()
+                if env._processed_arrivals >= next_snapshot:
+                    env.save_snapshot(snapshot_file)
+                    next_snapshot += env.snapshot_every
+
+            env.compute_simulation_stats()
+        else:
+            while len(env.events) > 0:
+                env.process_next_event()
+
+            env.compute_simulation_stats()
+        if snapshot_file is not None and os.path.isfile(snapshot_file):
+            os.remove(snapshot_file)
+        blocking_ratios.extend(record['request_blocking_ratio'] for record in env._simulation_records)
     # prepare observations
     logger.info(f'Finishing simulation for load {env.load} and policy {env.policy.name}')
+    env.seed = base_seed
+    return profiler.profile if profiler is not None else None
+
+
+def _attach_worker(env):
+    """
+    Gives the env a copy of the topology attached by init_worker() if it has none, and the queues of the process.
+    """
+    if env.topology is None:
+        if _worker_topology is None:
+            raise ValueError('The environment has no topology and the process was not initialized with init_worker()')
+        env.set_topology(_worker_topology.copy())
+    if env.plot_queue is None:
+        env.plot_queue = _worker_plot_queue
+    if env.results_queue is None:
+        env.results_queue = _worker_results_queue
+
+
+def _get_worker_logger():
+    logger = multiprocessing.get_logger()
+    if not logger.handlers:  # each call to log_to_stderr() adds a handler, and a process runs many simulations
+        logger = multiprocessing.log_to_stderr()
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def run_common_simulation(envs, seeds=None, block=1000):
+    """
+    Runs the simulations of several environments with the same seed over the same arrivals, i.e., with common random
+    numbers. The environments can differ in the routing policy and in the load (load sweep). The arrivals of each
+    seed are drawn once and replayed to all the environments through a traffic.SharedTrace, and the environments
+    advance together, block arrivals at a time, so that only the arrivals between the slowest and the fastest one are
+    kept. If the loads differ, the inter-arrival times of the trace (drawn for the load of the first environment) are
+    scaled to the load of each environment, so that all the loads see the same arrival pattern, compressed or
+    stretched. Each environment reports the same records as run_simulation().
+    If envs[0].ci_precision is set, the seeds stop as soon as the confidence intervals are narrow enough, using the
+    paired differences of the request blocking ratio of each policy to the first one of its load with common random
+    numbers (see results.get_paired_confidence_intervals).
+    """
+    if len({env.seed for env in envs}) > 1:
+        raise ValueError('The environments run with common random numbers must have the same seed')
+    for env in envs:
+        _attach_worker(env)
+    names = '/'.join(dict.fromkeys(env.policy.name for env in envs))
+    loads = '/'.join(dict.fromkeys(str(env.load) for env in envs))
+    logger = _get_worker_logger()
+    logger.info(f'Running simulation for loads {loads} and policies {names}')
+
+    # the blocking ratios of each environment are compared with the ones of the first environment with its load
+    references = {}
+    for idx, env in enumerate(envs):
+        references.setdefault(env.load, idx)
+    if seeds is None:
+        seeds = range(envs[0].num_seeds)
+    base_seed = envs[0].seed
+    # the trace is drawn for the load of the first environment, and its inter-arrival times scaled for the others
+    scales = [None if env.load == envs[0].load else
+              env.mean_service_inter_arrival_time / envs[0].mean_service_inter_arrival_time for env in envs]
+    blocking_ratios = [[] for _ in envs]
+    for seed in seeds:
+        if envs[0].ci_precision is not None and all(
+                stats.has_converged(np.subtract(blocking_ratios[idx], blocking_ratios[references[env.load]])
+                                    if envs[0].common_random_numbers and idx != references[env.load]
+                                    else blocking_ratios[idx], env.ci_precision, env.min_seeds, env.confidence)
+                for idx, env in enumerate(envs)):
+            logger.info(f'Stopping after {len(blocking_ratios[0])} seeds for loads {loads} and policies {names}')
+            break
+        simulation_seed = get_simulation_seed(base_seed, seed)
+        trace = traffic.SharedTrace(envs[0].get_traffic_generator(seed=simulation_seed), len(envs))
+        for env, reader in zip(envs, trace.get_readers(scales)):
+            env.reset(seed=simulation_seed, id_simulation=seed, traffic_generator=reader)
+        logger.info(f'Running simulation {seed} for loads {loads} and policies {names}')
+        target = 0
+        running = list(envs)
+        while len(running) > 0:
+            target += block
+            for env in running:
+                while len(env.events) > 0 and env._processed_arrivals < target:
+                    env.process_next_event()
+            running = [env for env in running if len(env.events) > 0]
+        for idx, env in enumerate(envs):
+            env.compute_simulation_stats()
+            blocking_ratios[idx].extend(record['request_blocking_ratio'] for record in env._simulation_records)
+    logger.info(f'Finishing simulation for loads {loads} and policies {names}')
+    for env in envs:
+        env.seed = base_seed
+
+
+def run_simulation_task(task):
+    """
+    Runs one work unit of the pool, i.e., a tuple (env, seed) with one seed of one configuration, a tuple
+    (env, tuple of seeds) with the seeds run together by the lockstep engine, or a tuple (list of env, seed) with one
+    seed of several configurations run with common random numbers (the policies of one load, the loads of one policy
+    in a load sweep, or both). Returns the number of records sent by the simulations
+    and their profile, if any.
+    """
+    env, seed = task
+    if isinstance(env, list):
+        run_common_simulation(env, seeds=[seed])
+        return {'records': sum(len(env_p._simulation_records) for env_p in env), 'profile': None}
+    profile = run_simulation(env, seeds=list(seed) if isinstance(seed, tuple) else [seed])
+    return {'records': len(env._simulation_records), 'profile': profile}
+
+
+def get_task_cost(task):
+    """
+    Expected cost of a work unit, used to start the longest ones first.
+    """
+    env, seed = task
+    envs = env if isinstance(env, list) else [env]
+    seeds = len(seed) if isinstance(seed, tuple) else 1
+    return seeds * sum(env_p.load * (env_p.warmup_arrivals + env_p.num_arrivals) for env_p in envs)
 
 
 class Service:
     """"
     Class that defines one service in the system.
     """
+    __slots__ = ('service_id', 'arrival_time', 'holding_time', 'source', 'source_id', 'destination', 'destination_id',
+                 'number_units', 'route', 'provisioned')
+
     def __init__(self, serv_id, at, ht, src, src_id, dst, dst_id, number_units=1):
         self.service_id = serv_id
         self.arrival_time = at
@@ -286,8 +986,10 @@ class Service:
 
 class Event:
     """
-    Class that models one event of the event queue.
+    Class that models one event of the event queue. The queue itself stores tuples, see Environment.add_event().
     """
+    __slots__ = ('time', 'call', 'params')
+
     def __init__(self, time=-1, call=None, params=None):
         self.time = time
         self.call = call
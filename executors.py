@@ -0,0 +1,332 @@
+import logging
+logging.basicConfig(format='%(asctime)s\t%(name)-12s\t%(threadName)s\t%(message)s', level=logging.DEBUG)
+
+import abc
+import argparse
+import glob
+import os
+import pickle
+import queue
+import socket
+import threading
+import time
+import traceback
+import uuid
+from multiprocessing import Pool
+from multiprocessing import Queue
+
+# imports of internal files
+import core
+import graph
+from results import add_record, collect_results, save_record
+
+
+class Executor(abc.ABC):
+    """
+    Runs the work units of a sweep, i.e., tuples (env, seed) with one seed of one configuration (see
+    core.run_simulation_task). The environments are sent without topology, which each backend provides to its
+    simulations once. Use it as a context manager: the backend is started when entering and stopped when leaving.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity  # number of units submitted and not completed that keeps all the workers busy
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def start(self):
+        pass
+
+    @abc.abstractmethod
+    def submit(self, task):
+        """
+        Submits one work unit (env, seed), where seed is a tuple of seeds with the lockstep engine.
+        """
+        pass
+
+    @abc.abstractmethod
+    def collect_results(self, results, timeout=None, units_folder=None):
+        """
+        Moves the records sent by the simulations into results[policy][load], saving them in units_folder if given.
+        Waits up to timeout seconds for the first one. Returns the number of records collected.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_completed(self):
+        """
+        Returns the outcomes of the units completed since the last call, i.e., dicts with the number of records
+        sent by the unit and its profile (see core.run_simulation_task). Raises an exception if a unit failed.
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class LocalPool(Executor):
+    """
+    Runs the units in a multiprocessing.Pool on this machine. The paths of the topology are placed in shared memory
+    once, and the records are streamed through a queue.
+    """
+    def __init__(self, topology, processes, plot_queue=None):
+        super().__init__(2 * processes)  # keeps a few units waiting for each process
+        self.topology = topology
+        self.processes = processes
+        self.plot_queue = plot_queue
+        self.shared_topology = None
+        self.pool = None
+        self.results_queue = Queue()
+        self.completed = queue.Queue()
+
+    def start(self):
+        self.shared_topology = graph.SharedTopology(self.topology)
+        logging.getLogger('executors').debug(f'Starting pool of simulators with {self.processes} threads')
+        self.pool = Pool(processes=self.processes, initializer=core.init_worker,
+                         initargs=(self.shared_topology, self.plot_queue, self.results_queue))
+
+    def submit(self, task):
+        self.pool.apply_async(core.run_simulation_task, (task,),
+                              callback=self.completed.put, error_callback=self.completed.put)
+
+    def collect_results(self, results, timeout=None, units_folder=None):
+        return collect_results(self.results_queue, results, timeout=timeout, units_folder=units_folder)
+
+    def get_completed(self):
+        outcomes = []
+        while not self.completed.empty():
+            outcome = self.completed.get()
+            if isinstance(outcome, BaseException):
+                raise outcome  # the simulation failed
+            outcomes.append(outcome)
+        return outcomes
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()  # all the units were completed, or the sweep failed
+            self.pool.join()
+        if self.shared_topology is not None:
+            self.shared_topology.unlink()
+
+
+class SpoolExecutor(Executor):
+    """
+    Coordinator of workers that share a directory (e.g., over NFS), which can run on several machines.
+    The coordinator writes the topology (with its k shortest paths) once to <spool>/topology.pickle, and each unit
+    to <spool>/tasks. A worker (see run_worker) claims a unit by renaming it into <spool>/claimed, which only one
+    worker can do, and writes the records of the unit to <spool>/done. While running a unit, the worker renews its
+    lease by touching the claimed file, and the units whose lease expires (e.g., of a worker that crashed) are moved
+    back to <spool>/tasks. The sweep fails if the lease of a unit expires max_attempts times. When the coordinator is
+    closed, it writes <spool>/stop, and the workers exit once no units are left.
+    """
+    def __init__(self, topology, folder, capacity, poll_interval=.1, lease=60., max_attempts=3):
+        super().__init__(capacity)
+        self.topology = topology
+        self.folder = folder
+        self.poll_interval = poll_interval
+        self.lease = lease  # seconds without renewal after which a claimed unit is run again
+        self.max_attempts = max_attempts
+        self.run_id = uuid.uuid4().hex  # identifies the sweep, so that workers do not mix different sweeps
+        self.submitted = 0
+        self.outcomes = []
+        self.attempts = {}  # number of times each unit was claimed and its lease expired
+        self.completed = set()  # units whose outcome was collected, as a unit run again can be completed twice
+
+    def start(self):
+        for subfolder in ['tasks', 'claimed', 'done']:
+            os.makedirs(os.path.join(self.folder, subfolder), exist_ok=True)
+        for file in glob.glob(os.path.join(self.folder, '*', '*.pickle')):
+            os.remove(file)  # units left by a sweep that was interrupted
+        if os.path.isfile(os.path.join(self.folder, 'stop')):
+            os.remove(os.path.join(self.folder, 'stop'))
+        _write_pickle(os.path.join(self.folder, 'topology.pickle'),
+                      {'run_id': self.run_id, 'topology': self.topology, 'lease': self.lease})
+
+    def submit(self, task):
+        env, seed = task
+        envs = env if isinstance(env, list) else [env]  # several configurations with common random numbers
+        policies = '+'.join(dict.fromkeys(env_p.policy.name for env_p in envs))
+        loads = '+'.join(dict.fromkeys(str(env_p.load) for env_p in envs))
+        # the units are named in the order they are submitted, which the workers follow
+        seeds = '+'.join(str(seed_p) for seed_p in seed) if isinstance(seed, tuple) else seed  # lockstep engine
+        name = f'{self.submitted:08d}_{policies}_{loads}_{seeds}.pickle'
+        _write_pickle(os.path.join(self.folder, 'tasks', name), {'run_id': self.run_id, 'task': task})
+        self.submitted += 1
+
+    def collect_results(self, results, timeout=None, units_folder=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self.requeue_expired()
+            files = sorted(glob.glob(os.path.join(self.folder, 'done', '*.pickle')))
+            if len(files) > 0 or (deadline is not None and time.time() >= deadline):
+                break
+            time.sleep(self.poll_interval)
+        collected = 0
+        for file in files:
+            with open(file, 'rb') as data:
+                done = pickle.load(data)
+            os.remove(file)
+            name = os.path.basename(file)
+            if name in self.completed:
+                continue  # the unit was run again after its lease expired, and its records were already collected
+            self.completed.add(name)
+            if 'error' in done:
+                raise RuntimeError(f'The unit {os.path.basename(file)} failed in worker {done["worker"]}:\n'
+                                   f'{done["error"]}')
+            for record in done['records']:
+                if units_folder is not None:
+                    save_record(units_folder, record)
+                add_record(results, record)
+                collected += 1
+            self.outcomes.append(done['outcome'])
+        return collected
+
+    def requeue_expired(self):
+        """
+        Moves the claimed units whose lease expired back to <spool>/tasks, so that another worker runs them.
+        Raises an exception if a unit expired max_attempts times, e.g., because it makes the workers crash.
+        """
+        for file in glob.glob(os.path.join(self.folder, 'claimed', '*.pickle')):
+            try:
+                expired = time.time() - os.path.getmtime(file) > self.lease
+            except FileNotFoundError:
+                continue  # completed meanwhile
+            name = os.path.basename(file)
+            if not expired or name in self.completed:
+                continue
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            if self.attempts[name] >= self.max_attempts:
+                raise RuntimeError(f'The lease of unit {name} expired {self.attempts[name]} times')
+            try:
+                os.rename(file, os.path.join(self.folder, 'tasks', name))
+            except FileNotFoundError:
+                continue  # completed meanwhile
+            logging.getLogger('executors').warning(f'The lease of unit {name} expired, it is queued again')
+
+    def get_completed(self):
+        outcomes, self.outcomes = self.outcomes, []
+        return outcomes
+
+    def close(self):
+        if os.path.isfile(os.path.join(self.folder, 'topology.pickle')):
+            os.remove(os.path.join(self.folder, 'topology.pickle'))
+        with open(os.path.join(self.folder, 'stop'), 'wt') as file:
+            file.write(self.run_id)
+
+
+def _write_pickle(file, data):
+    # written under a temporary name and then renamed, so that the other processes never read a partial file
+    with open(file + '.tmp', 'wb') as output:
+        pickle.dump(data, output)
+    os.replace(file + '.tmp', file)
+
+
+def get_executor(args, topology, plot_queue=None):
+    """
+    Returns the executor selected by args.executor: 'local' (default) or 'spool' with the folder args.spool_folder.
+    """
+    executor = args.executor if hasattr(args, 'executor') else 'local'
+    if executor == 'local':
+        return LocalPool(topology, args.threads, plot_queue=plot_queue)
+    elif executor == 'spool':
+        lease = args.spool_lease if hasattr(args, 'spool_lease') else 60.
+        return SpoolExecutor(topology, args.spool_folder, capacity=2 * args.threads, lease=lease)
+    raise ValueError('Executor was not configured correctly (value set to {})'.format(executor))
+
+
+def run_worker(folder, poll_interval=1.):
+    """
+    Worker of a SpoolExecutor: loads the topology once, then claims and runs units until the coordinator stops.
+    Several workers can run on the same machine or on machines sharing the folder. The topology is loaded again
+    when a unit of another sweep is claimed, e.g., if the worker outlived a previous sweep.
+    """
+    logger = logging.getLogger('worker')
+    worker = f'{socket.gethostname()}-{os.getpid()}'
+    spool = _load_spool(folder, poll_interval)
+    logger.info(f'Worker {worker} loaded the topology of sweep {spool["run_id"]}')
+
+    while True:
+        claimed = None
+        for file in sorted(glob.glob(os.path.join(folder, 'tasks', '*.pickle'))):
+            target = os.path.join(folder, 'claimed', os.path.basename(file))
+            try:
+                os.rename(file, target)  # atomic: only one worker succeeds
+                os.utime(target)  # starts the lease, as the rename keeps the time the unit was submitted
+            except FileNotFoundError:
+                continue  # claimed by another worker, or queued again by the coordinator
+            claimed = target
+            break
+        if claimed is None:
+            stop_file = os.path.join(folder, 'stop')
+            if os.path.isfile(stop_file):
+                with open(stop_file, 'rt') as file:
+                    if file.read() == spool['run_id']:
+                        logger.info(f'Worker {worker} finished')
+                        return
+            time.sleep(poll_interval)
+            continue
+
+        with open(claimed, 'rb') as data:
+            unit = pickle.load(data)
+        name = os.path.basename(claimed)
+        if unit['run_id'] != spool['run_id']:
+            spool = _load_spool(folder, poll_interval)  # the sweep changed since the topology was loaded
+            logger.info(f'Worker {worker} loaded the topology of sweep {spool["run_id"]}')
+            if unit['run_id'] != spool['run_id']:
+                os.remove(claimed)  # unit left by a previous sweep
+                continue
+        env, seed = unit['task']
+        envs = env if isinstance(env, list) else [env]
+        stop_renewal = threading.Event()
+        renewal = threading.Thread(target=_renew_lease, args=(claimed, spool['lease'] / 4, stop_renewal), daemon=True)
+        renewal.start()
+        try:
+            for env_p in envs:
+                env_p.set_topology(spool['topology'].copy())  # the paths are shared by all the simulations
+                env_p.results = {env_p.policy.name: {env_p.load: []}}
+            outcome = core.run_simulation_task((env, seed))
+            done = {'worker': worker, 'records': [record for env_p in envs for record in env_p._simulation_records],
+                    'outcome': outcome}
+        except Exception:
+            done = {'worker': worker, 'error': traceback.format_exc()}
+        stop_renewal.set()
+        renewal.join()
+        _write_pickle(os.path.join(folder, 'done', name), done)
+        try:
+            os.remove(claimed)
+        except FileNotFoundError:
+            pass  # the lease expired and the coordinator queued the unit again
+
+
+def _load_spool(folder, poll_interval):
+    # waits for the coordinator to write the topology of its sweep
+    topology_file = os.path.join(folder, 'topology.pickle')
+    while True:
+        try:
+            with open(topology_file, 'rb') as data:
+                return pickle.load(data)
+        except FileNotFoundError:
+            time.sleep(poll_interval)
+
+
+def _renew_lease(file, interval, stop):
+    # touches the claimed unit until the worker completes it, so that the coordinator does not run it again
+    while not stop.wait(interval):
+        try:
+            os.utime(file)
+        except FileNotFoundError:
+            return  # the lease expired and the coordinator queued the unit again
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Worker of a sweep run with python run.py --executor spool')
+    parser.add_argument('command', choices=['worker'])
+    parser.add_argument('--spool', required=True,
+                        help='Folder shared with the coordinator (the --spool_folder of run.py)')
+    parser.add_argument('--poll_interval', type=float, default=1.,
+                        help='Time in seconds between checks for new units (default=1)')
+    args = parser.parse_args()
+    run_worker(args.spool, poll_interval=args.poll_interval)
@@ -1,7 +1,13 @@
+from collections import OrderedDict
 from itertools import islice
+import hashlib
+import heapq
+import json
 import math
-from xml.dom.minidom import parse
-import xml.dom.minidom
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+from xml.etree import ElementTree
 import networkx as nx
 import numpy as np
 import logging
@@ -14,16 +20,262 @@ def get_k_shortest_paths(G, source, target, k, weight=None):
     return list(islice(nx.shortest_simple_paths(G, source, target, weight=weight), k))
 
 
+def get_disjoint_paths(G, source, target, k, weight=None):
+    """
+    Up to k link-disjoint paths, found one after the other as the shortest path avoiding the links of the
+    previous ones.
+    """
+    blocked = set()
+
+    def link_weight(node1, node2, data):
+        return None if data['index'] in blocked else (data[weight] if weight is not None else 1)  # None hides the link
+
+    paths = []
+    for _ in range(k):
+        try:
+            path = nx.dijkstra_path(G, source, target, weight=link_weight)
+        except nx.NetworkXNoPath:
+            break
+        paths.append(path)
+        blocked.update(G[path[i]][path[i + 1]]['index'] for i in range(len(path) - 1))
+    return paths
+
+
+class CSRGraph:
+    """
+    Adjacency of a topology in compressed sparse row (CSR) format, built with NumPy, with the path algorithms of the
+    'csr' k-shortest-path backend: Dijkstra's algorithm with blocked nodes and links, Yen's k shortest simple paths
+    and link-disjoint paths. Nodes are identified by their position in topology.graph['node_indices'] and links by
+    their `index`, which is the same for both directions.
+    """
+    def __init__(self, topology, weight=None):
+        self.nodes = list(topology.graph['node_indices'])
+        self.node_position = {node: idx for idx, node in enumerate(self.nodes)}
+        edges = [(self.node_position[n1], self.node_position[n2], data[weight] if weight is not None else 1,
+                  data['index']) for n1, n2, data in topology.edges(data=True)]
+        edges = np.array(edges, dtype=float).reshape(-1, 4)
+        # each link is stored in both directions
+        sources = np.concatenate([edges[:, 0], edges[:, 1]]).astype(int)
+        targets = np.concatenate([edges[:, 1], edges[:, 0]]).astype(int)
+        order = np.lexsort((targets, sources))
+        self.indptr = np.searchsorted(sources[order], np.arange(len(self.nodes) + 1))
+        self.indices = targets[order]
+        self.weights = np.concatenate([edges[:, 2], edges[:, 2]])[order]
+        self.links = np.concatenate([edges[:, 3], edges[:, 3]]).astype(int)[order]
+        # the algorithms loop over Python lists, which are faster than indexing arrays element by element
+        self._adjacency = [list(zip(self.indices[start:end].tolist(), self.weights[start:end].tolist(),
+                                    self.links[start:end].tolist()))
+                           for start, end in zip(self.indptr[:-1].tolist(), self.indptr[1:].tolist())]
+        self.unit_weights = bool(np.all(self.weights == 1))
+        self._link = {}
+        for node1, neighbors in enumerate(self._adjacency):
+            for node2, link_weight, link in neighbors:
+                self._link[node1, node2] = (link, link_weight)
+
+    def shortest_path(self, source, target, blocked_nodes=(), blocked_links=()):
+        """
+        Dijkstra's algorithm (a breadth-first search if all the weights are 1) from source to target, without the
+        blocked nodes and links. Returns (cost, list of nodes), or None if target cannot be reached.
+        """
+        adjacency = self._adjacency
+        if self.unit_weights:
+            previous = {source: None}
+            frontier = [source]
+            while len(frontier) > 0:
+                next_frontier = []
+                for node in frontier:
+                    for neighbor, _, link in adjacency[node]:
+                        if neighbor in previous or neighbor in blocked_nodes or link in blocked_links:
+                            continue
+                        previous[neighbor] = node
+                        if neighbor == target:
+                            path = [target]
+                            while path[-1] != source:
+                                path.append(previous[path[-1]])
+                            return float(len(path) - 1), path[::-1]
+                        next_frontier.append(neighbor)
+                frontier = next_frontier
+            return None
+        distance = {source: 0.0}
+        previous = {}
+        done = set()
+        heap = [(0.0, source)]
+        while len(heap) > 0:
+            cost, node = heapq.heappop(heap)
+            if node in done:
+                continue
+            if node == target:
+                path = [target]
+                while path[-1] != source:
+                    path.append(previous[path[-1]])
+                return cost, path[::-1]
+            done.add(node)
+            for neighbor, link_weight, link in adjacency[node]:
+                if neighbor in done or neighbor in blocked_nodes or link in blocked_links:
+                    continue
+                new_cost = cost + link_weight
+                if new_cost < distance.get(neighbor, math.inf):
+                    distance[neighbor] = new_cost
+                    previous[neighbor] = node
+                    heapq.heappush(heap, (new_cost, neighbor))
+        return None
+
+    def k_shortest_paths(self, source, target, k):
+        """
+        Yen's algorithm: the k shortest simple paths from source to target, as lists of nodes.
+        """
+        first = self.shortest_path(source, target)
+        if first is None:
+            return []
+        paths = [first[1]]
+        candidates = []  # heap of (cost, hops, sequence number, path)
+        seen = {tuple(first[1])}
+        while len(paths) < k:
+            last = paths[-1]
+            root_cost = 0.0
+            for j in range(len(last) - 1):
+                root = last[:j + 1]
+                # links leaving the spur node along the paths found with the same root, and nodes of the root
+                blocked_links = {self._link[path[j], path[j + 1]][0] for path in paths
+                                 if len(path) > j + 1 and path[:j + 1] == root}
+                spur = self.shortest_path(last[j], target, blocked_nodes=set(root[:-1]), blocked_links=blocked_links)
+                if spur is not None:
+                    path = root[:-1] + spur[1]
+                    if tuple(path) not in seen:
+                        seen.add(tuple(path))
+                        heapq.heappush(candidates, (root_cost + spur[0], len(path), len(seen), path))
+                root_cost += self._link[last[j], last[j + 1]][1]
+            if len(candidates) == 0:
+                break
+            paths.append(heapq.heappop(candidates)[3])
+        return paths
+
+    def disjoint_paths(self, source, target, k):
+        """
+        Up to k link-disjoint paths from source to target, as lists of nodes (see get_disjoint_paths).
+        """
+        paths = []
+        blocked_links = set()
+        for _ in range(k):
+            path = self.shortest_path(source, target, blocked_links=blocked_links)
+            if path is None:
+                break
+            paths.append(path[1])
+            blocked_links.update(self._link[path[1][i], path[1][i + 1]][0] for i in range(len(path[1]) - 1))
+        return paths
+
+    def get_paths(self, n1, n2, k, disjoint=False):
+        """
+        Paths between the nodes n1 and n2 (given by name), as lists of node names.
+        """
+        source, target = self.node_position[n1], self.node_position[n2]
+        paths = self.disjoint_paths(source, target, k) if disjoint else self.k_shortest_paths(source, target, k)
+        return [[self.nodes[node] for node in path] for path in paths]
+
+
+KSP_BACKENDS = ['networkx', 'csr']
+
+
+def get_pair_paths(topology, n1, n2, k, weight=None, backend='networkx', disjoint=False, csr=None):
+    """
+    Computes the k shortest paths between n1 and n2 with the given backend (for 'csr', the CSRGraph of the topology
+    can be given to avoid building it), or k link-disjoint paths if disjoint is set. Returns a list of Path.
+    """
+    if backend == 'csr':
+        csr = csr if csr is not None else CSRGraph(topology, weight=weight)
+        paths = csr.get_paths(n1, n2, k, disjoint=disjoint)
+    elif backend == 'networkx':
+        if disjoint:
+            paths = get_disjoint_paths(topology, n1, n2, k, weight=weight)
+        else:
+            paths = get_k_shortest_paths(topology, n1, n2, k, weight=weight)
+    else:
+        raise ValueError(f'Unknown k-shortest-path backend {backend}')
+    return [Path(path, get_path_weight(topology, path), edge_indices=get_edge_indices(topology, path)) for path in paths]
+
+
+class LazyKShortestPaths:
+    """
+    Computes the paths of a node pair (and their link table) the first time they are requested, and keeps the
+    ones of the maxsize pairs used most recently (all of them if maxsize is None). Both directions of a pair share
+    the same paths, computed from the node that comes first in topology.graph['node_indices'], as with the eager
+    computation. Set with set_lazy_k_shortest_paths().
+    """
+    def __init__(self, topology, k, weight=None, backend='networkx', disjoint=False, maxsize=None):
+        self.topology = topology
+        self.k = k
+        self.weight = weight
+        self.backend = backend
+        self.disjoint = disjoint
+        self.maxsize = maxsize
+        self.node_position = {node: idx for idx, node in enumerate(topology.graph['node_indices'])}
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._csr = None
+
+    def __getstate__(self):
+        # the paths are not sent to other processes, which compute the ones they need
+        state = dict(self.__dict__, cache=OrderedDict(), hits=0, misses=0, _csr=None)
+        return state
+
+    def get(self, n1, n2):
+        """
+        Returns the paths and the link table of the node pair (see get_path_links).
+        """
+        key = (n1, n2) if self.node_position[n1] < self.node_position[n2] else (n2, n1)
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return entry
+        self.misses += 1
+        if self.backend == 'csr' and self._csr is None:
+            self._csr = CSRGraph(self.topology, weight=self.weight)
+        paths = get_pair_paths(self.topology, key[0], key[1], self.k, weight=self.weight, backend=self.backend,
+                               disjoint=self.disjoint, csr=self._csr)
+        entry = (paths, get_path_links(paths))
+        self.cache[key] = entry
+        if self.maxsize is not None and len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)  # least recently used
+        return entry
+
+
+class LazyPathView:
+    """
+    Read-only mapping (n1, n2) -> paths (part 0) or link table (part 1) of a LazyKShortestPaths, used as
+    topology.graph['ksp'] and topology.graph['ksp_links'].
+    """
+    def __init__(self, lazy, part):
+        self.lazy = lazy
+        self.part = part
+
+    def __getitem__(self, pair):
+        return self.lazy.get(*pair)[self.part]
+
+
+def set_lazy_k_shortest_paths(topology, k, weight=None, backend='networkx', disjoint=False, maxsize=None):
+    lazy = LazyKShortestPaths(topology, k, weight=weight, backend=backend, disjoint=disjoint, maxsize=maxsize)
+    topology.graph['ksp'] = LazyPathView(lazy, 0)
+    topology.graph['ksp_links'] = LazyPathView(lazy, 1)
+
+
 def get_path_weight(graph, path, weight='length'):
     return np.sum([graph[path[i]][path[i+1]][weight] for i in range(len(path) - 1)])
 
 
 class Path:
 
-    def __init__(self, node_list, length):
+    def __init__(self, node_list, length, edge_indices=None):
         self.node_list = node_list
         self.length = length
         self.hops = len(node_list) - 1
+        # indices of the links (attribute `index` of each edge) traversed by the path, used by the link-state arrays
+        self.edge_indices = edge_indices
+
+
+def get_edge_indices(graph, path):
+    return np.array([graph[path[i]][path[i + 1]]['index'] for i in range(len(path) - 1)], dtype=int)
 
 
 def calculate_geographical_distance(latlong1, latlong2):
@@ -44,59 +296,557 @@ def calculate_geographical_distance(latlong1, latlong2):
     return length
 
 
+def get_link_length(graph, node1, node2):
+    """
+    Length of the link between two nodes computed from their positions, following graph.graph["coordinatesType"].
+    """
+    if graph.graph["coordinatesType"] == "geographical":
+        return np.around(calculate_geographical_distance(graph.nodes[node1]["pos"], graph.nodes[node2]["pos"]), 3)
+    latlong1 = graph.nodes[node1]["pos"]
+    latlong2 = graph.nodes[node2]["pos"]
+    return np.around(math.sqrt((latlong1[0] - latlong2[0]) ** 2 + (latlong1[1] - latlong2[1]) ** 2), 3)
+
+
+def add_link(graph, node1, node2, link_id=None, length=None):
+    """
+    Adds a link to a topology, computing its length from the positions of the nodes if it is not given.
+    Links without id are named after their index.
+    """
+    if length is None:
+        length = get_link_length(graph, node1, node2)
+    # indices are kept contiguous (0 to E-1) as they address the link-state arrays
+    # the links are counted while reading, as graph.number_of_edges() takes a time proportional to the nodes
+    if graph.has_edge(node1, node2):
+        idx = graph[node1][node2]['index']
+    else:
+        idx = graph.graph.get("_num_links", 0)
+        graph.graph["_num_links"] = idx + 1
+    graph.add_edge(node1, node2, id=link_id if link_id is not None else f'L{idx}', weight=1.0, length=length,
+                   index=idx)
+
+
+def finish_topology(graph):
+    """
+    Sets the order of the nodes of a topology that was read or generated.
+    """
+    graph.graph.pop("_num_links", None)
+    graph.graph["node_indices"] = list(graph.nodes())
+    return graph
+
+
 def read_sndlib_topology(file):
+    """
+    Reads a topology in the SNDlib XML format. The file is streamed with iterparse, and each node and link is
+    discarded once added to the graph.
+    """
     graph = nx.Graph()
+    graph.graph["coordinatesType"] = ""
+    node = link = None
+    for event, element in ElementTree.iterparse(file, events=("start", "end")):
+        tag = element.tag.rsplit("}", 1)[-1]  # removes the namespace
+        if event == "start":
+            if tag == "nodes":
+                graph.graph["coordinatesType"] = element.get("coordinatesType", "")
+            elif tag == "node":
+                node = {"id": element.get("id")}
+            elif tag == "link":
+                link = {"id": element.get("id")}
+        elif node is not None:
+            if tag in ["x", "y"]:
+                node[tag] = float(element.text)
+            elif tag == "node":
+                graph.add_node(node["id"], pos=(node["x"], node["y"]))
+                node = None
+                element.clear()
+        elif link is not None:
+            if tag in ["source", "target"] and tag not in link:
+                link[tag] = element.text.strip()
+            elif tag == "link":
+                add_link(graph, link["source"], link["target"], link["id"])
+                link = None
+                element.clear()
+    return finish_topology(graph)
 
-    with open('config/topologies/' + file) as file:
-        tree = xml.dom.minidom.parse(file)
-        document = tree.documentElement
-
-        graph.graph["coordinatesType"] = document.getElementsByTagName("nodes")[0].getAttribute("coordinatesType")
-
-        nodes = document.getElementsByTagName("node")
-        for node in nodes:
-            x = node.getElementsByTagName("x")[0]
-            y = node.getElementsByTagName("y")[0]
-            graph.add_node(node.getAttribute("id"), pos=((float(x.childNodes[0].data), float(y.childNodes[0].data))))
-        links = document.getElementsByTagName("link")
-        for idx, link in enumerate(links):
-            source = link.getElementsByTagName("source")[0]
-            target = link.getElementsByTagName("target")[0]
-
-            if graph.graph["coordinatesType"] == "geographical":
-                length = np.around(calculate_geographical_distance(graph.nodes[source.childNodes[0].data]["pos"], graph.nodes[target.childNodes[0].data]["pos"]), 3)
-            else:
-                latlong1 = graph.nodes[source.childNodes[0].data]["pos"]
-                latlong2 = graph.nodes[target.childNodes[0].data]["pos"]
-                length = np.around(math.sqrt((latlong1[0] - latlong2[0]) ** 2 + (latlong1[1] - latlong2[1]) ** 2), 3)
-
-            weight = 1.0
-            graph.add_edge(source.childNodes[0].data, target.childNodes[0].data,
-                           id=link.getAttribute("id"), weight=weight, length=length, index=idx)
-    graph.graph["node_indices"] = []
-    for idx, node in enumerate(graph.nodes()):
-        graph.graph["node_indices"].append(node)
 
-    return graph
+def read_sndlib_native_topology(file):
+    """
+    Reads a topology in the SNDlib native (text) format, using its NODES and LINKS sections. The coordinates are
+    considered geographical, as in the SNDlib networks.
+    """
+    graph = nx.Graph()
+    graph.graph["coordinatesType"] = "geographical"
+    section = None
+    with open(file, 'rt') as lines:
+        for line in lines:
+            line = line.split("#", 1)[0].strip()
+            if len(line) == 0:
+                continue
+            if line.endswith("(") and section is None:
+                section = line[:-1].strip()
+            elif line == ")":
+                section = None
+            elif section == "NODES":
+                # <node_id> ( <longitude> <latitude> )
+                name, coordinates = line.split("(", 1)
+                x, y = coordinates.split(")", 1)[0].split()
+                graph.add_node(name.strip(), pos=(float(x), float(y)))
+            elif section == "LINKS":
+                # <link_id> ( <source> <target> ) <capacities and costs> ( <modules> )
+                link_id, nodes = line.split("(", 1)
+                source, target = nodes.split(")", 1)[0].split()
+                add_link(graph, source, target, link_id.strip())
+    return finish_topology(graph)
 
 
-def get_topology(args):
+def read_gml_topology(file):
+    """
+    Reads a topology in the GML format. The positions of the nodes are taken from their attributes pos, x and y,
+    or Longitude and Latitude (as in the Internet Topology Zoo, in which case they are geographical). The length of
+    each link is taken from its attribute length or computed from the positions of its nodes.
+    """
+    gml = nx.read_gml(file, label="label")
+    return _get_topology_from_graph(gml)
+
+
+def read_json_topology(file):
+    """
+    Reads a topology from a JSON file with a list of links ("links" or "edges") with "source" and "target", and
+    optionally "id" and "length", and an optional list of "nodes" with "id" and positions as in read_gml_topology.
+    This includes the node-link format of NetworkX.
+    """
+    with open(file, 'rt') as data:
+        content = json.load(data)
+    gml = nx.Graph()
+    for node in content.get("nodes", []):
+        gml.add_node(node["id"], **{key: value for key, value in node.items() if key != "id"})
+    for link in content.get("links", content.get("edges", [])):
+        gml.add_edge(link["source"], link["target"],
+                     **{key: value for key, value in link.items() if key not in ["source", "target"]})
+    return _get_topology_from_graph(gml)
+
+
+def _get_topology_from_graph(source_graph):
+    """
+    Builds a topology from a NetworkX graph read from a file, keeping only the attributes used by the simulator.
+    """
+    graph = nx.Graph()
+    geographical = any("Longitude" in data for _, data in source_graph.nodes(data=True))
+    graph.graph["coordinatesType"] = "geographical" if geographical else "pixel"
+    for node, data in source_graph.nodes(data=True):
+        if "pos" in data:
+            pos = tuple(float(x) for x in data["pos"])
+        elif "Longitude" in data:
+            pos = (float(data["Longitude"]), float(data["Latitude"]))
+        elif "x" in data:
+            pos = (float(data["x"]), float(data["y"]))
+        else:
+            pos = None
+        graph.add_node(str(node), pos=pos)
+    for node1, node2, data in source_graph.edges(data=True):
+        length = data.get("length")
+        if length is None and (graph.nodes[str(node1)]["pos"] is None or graph.nodes[str(node2)]["pos"] is None):
+            length = 1.0  # without positions, all links have the same length
+        add_link(graph, str(node1), str(node2), str(data["id"]) if "id" in data else None,
+                 length=float(length) if length is not None else None)
+    return finish_topology(graph)
+
+
+def get_grid_topology(rows, columns, length=100.0):
+    """
+    Synthetic rows x columns grid topology, with links of the given length between neighbouring nodes.
+    """
+    graph = nx.Graph()
+    graph.graph["coordinatesType"] = "pixel"
+    for row in range(rows):
+        for column in range(columns):
+            graph.add_node(f'{row}_{column}', pos=(column * length, row * length))
+    for row in range(rows):
+        for column in range(columns):
+            for neighbor in [(row, column + 1), (row + 1, column)]:
+                if neighbor[0] < rows and neighbor[1] < columns:
+                    add_link(graph, f'{row}_{column}', f'{neighbor[0]}_{neighbor[1]}', length=length)
+    return finish_topology(graph)
+
+
+def get_random_geometric_topology(num_nodes, radius, seed=0, size=1000.0):
+    """
+    Synthetic random geometric topology: the nodes are placed uniformly in a square of side size, and each pair of
+    nodes closer than radius * size is linked. Disconnected parts are joined by their closest pair of nodes.
+    """
+    return _get_synthetic_topology(nx.random_geometric_graph(num_nodes, radius, seed=seed), size)
+
+
+def get_waxman_topology(num_nodes, beta=0.4, alpha=0.1, seed=0, size=1000.0):
+    """
+    Synthetic Waxman topology: the nodes are placed uniformly in a square of side size, and two nodes at distance d
+    are linked with probability beta * exp(-d / (alpha * L)), where L is the largest distance. Disconnected parts are
+    joined by their closest pair of nodes.
+    """
+    return _get_synthetic_topology(nx.waxman_graph(num_nodes, beta=beta, alpha=alpha, seed=seed), size)
+
+
+def _get_synthetic_topology(source_graph, size):
+    graph = nx.Graph()
+    graph.graph["coordinatesType"] = "pixel"
+    for node, pos in source_graph.nodes(data="pos"):
+        graph.add_node(str(node), pos=(pos[0] * size, pos[1] * size))
+    for node1, node2 in source_graph.edges():
+        add_link(graph, str(node1), str(node2))
+    # joins the component of the first node to its closest node in the other components, until all are connected
+    nodes = list(graph.nodes())
+    positions = np.array([graph.nodes[node]["pos"] for node in nodes])
+    while not nx.is_connected(graph):
+        component = np.zeros(len(nodes), dtype=bool)
+        component[[nodes.index(node) for node in nx.node_connected_component(graph, nodes[0])]] = True
+        distances = np.linalg.norm(positions[component][:, None, :] - positions[~component][None, :, :], axis=2)
+        inner, outer = np.unravel_index(np.argmin(distances), distances.shape)
+        add_link(graph, nodes[np.flatnonzero(component)[inner]], nodes[np.flatnonzero(~component)[outer]])
+    return finish_topology(graph)
+
+
+def get_synthetic_topology(spec):
+    """
+    Generates the synthetic topology given by spec, in one of the formats:
+    grid:<rows>x<columns>, geometric:<nodes>:<radius>[:<seed>] or waxman:<nodes>:<beta>:<alpha>[:<seed>].
+    """
+    kind, *params = spec.split(":")
+    if kind == "grid":
+        rows, columns = [int(x) for x in params[0].split("x")]
+        return get_grid_topology(rows, columns)
+    elif kind == "geometric":
+        return get_random_geometric_topology(int(params[0]), float(params[1]),
+                                             seed=int(params[2]) if len(params) > 2 else 0)
+    elif kind == "waxman":
+        return get_waxman_topology(int(params[0]), beta=float(params[1]), alpha=float(params[2]),
+                                   seed=int(params[3]) if len(params) > 3 else 0)
+    raise ValueError(f"Unknown synthetic topology {spec}")
+
+
+def is_synthetic_topology(topology_file):
+    return topology_file.split(":")[0] in SYNTHETIC_TOPOLOGIES and ":" in topology_file
+
+
+def get_topology_path(topology_file):
+    """
+    Path of a topology file, which is looked up as given and then in config/topologies.
+    """
+    if os.path.isfile(topology_file):
+        return topology_file
+    return os.path.join('config', 'topologies', topology_file)
+
+
+def get_topology_name(topology_file):
+    """
+    Name of a topology, i.e., its file name without extension, or the spec of a synthetic topology.
+    """
+    if is_synthetic_topology(topology_file):
+        return topology_file.replace(":", "_")
+    return os.path.splitext(os.path.basename(topology_file))[0]
+
+
+def read_topology(topology_file):
+    """
+    Reads a topology file according to its extension (.xml for SNDlib XML, .txt for SNDlib native, .gml or .json),
+    or generates a synthetic topology (see get_synthetic_topology).
+    """
+    if is_synthetic_topology(topology_file):
+        return get_synthetic_topology(topology_file)
+    path = get_topology_path(topology_file)
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in TOPOLOGY_READERS:
+        raise ValueError("Supplied topology is unknown")
+    return TOPOLOGY_READERS[extension](path)
+
+
+TOPOLOGY_READERS = {
+    ".xml": read_sndlib_topology,
+    ".txt": read_sndlib_native_topology,
+    ".gml": read_gml_topology,
+    ".json": read_json_topology,
+}
+SYNTHETIC_TOPOLOGIES = ["grid", "geometric", "waxman"]
+
+
+def get_path_links(paths):
+    """
+    Returns the k x H link table of a list of paths, where H is the largest number of hops among them, i.e., row i
+    has the edge indices of path i, padded with its last link, which does not change the availability or the
+    maximum usage of the path.
+    """
+    links = np.zeros((len(paths), max([path.hops for path in paths], default=1)), dtype=np.int64)
+    for idp, path in enumerate(paths):
+        links[idp, :path.hops] = path.edge_indices
+        links[idp, path.hops:] = path.edge_indices[-1]
+    return links
+
+
+def compute_k_shortest_paths(topology, k, weight=None, processes=1, backend='networkx', disjoint=False):
+    """
+    Computes the k shortest paths (or k link-disjoint paths if disjoint is set) of every node pair (n1, n2), with n1
+    before n2 in the node order, using the given backend (see get_pair_paths).
+    If processes > 1, the source nodes are split among a pool of processes, and the results are merged in the
+    node order so that the output does not depend on the number of processes.
+    Returns a dict (n1, n2) -> list of Path.
+    """
+    sources = range(topology.number_of_nodes())
+    if processes is not None and processes > 1 and topology.number_of_nodes() > 2:
+        with multiprocessing.Pool(processes=processes, initializer=_init_ksp_worker,
+                                  initargs=(topology, k, weight, backend, disjoint)) as pool:
+            # one source per task, as the first sources have more pairs to compute than the last ones
+            per_source = pool.map(_compute_source_paths, sources, chunksize=1)
+    else:
+        _init_ksp_worker(topology, k, weight, backend, disjoint)
+        per_source = [_compute_source_paths(idn1) for idn1 in sources]
+        _ksp_worker.clear()
+    k_shortest_paths = {}
+    for source_paths in per_source:
+        k_shortest_paths.update(source_paths)
+    return k_shortest_paths
+
+
+# state of the processes computing the k shortest paths
+_ksp_worker = {}
+
+
+def _init_ksp_worker(topology, k, weight, backend='networkx', disjoint=False):
+    _ksp_worker['topology'] = topology
+    _ksp_worker['k'] = k
+    _ksp_worker['weight'] = weight
+    _ksp_worker['backend'] = backend
+    _ksp_worker['disjoint'] = disjoint
+    _ksp_worker['csr'] = CSRGraph(topology, weight=weight) if backend == 'csr' else None
+
+
+def _compute_source_paths(idn1):
+    """
+    Computes the k shortest paths from the idn1-th node to all the nodes after it in the node order.
+    """
+    topology = _ksp_worker['topology']
+    nodes = list(topology.nodes())
+    k_shortest_paths = {}
+    for n2 in nodes[idn1 + 1:]:
+        k_shortest_paths[nodes[idn1], n2] = get_pair_paths(topology, nodes[idn1], n2, _ksp_worker['k'],
+                                                           weight=_ksp_worker['weight'],
+                                                           backend=_ksp_worker['backend'],
+                                                           disjoint=_ksp_worker['disjoint'], csr=_ksp_worker['csr'])
+    return k_shortest_paths
+
+
+def set_k_shortest_paths(topology, k_shortest_paths, path_links=None):
+    """
+    Stores the paths in topology.graph['ksp'] (both directions) and their link tables (see get_path_links) in
+    topology.graph['ksp_links']. The link tables are computed if not given.
+    """
+    ksp = {}
+    compute_links = path_links is None
+    if compute_links:
+        path_links = {}
+    for (n1, n2), objs in k_shortest_paths.items():
+        # both directions have the same paths, i.e., bidirectional symetrical links
+        ksp[n1, n2] = objs
+        ksp[n2, n1] = objs
+        if compute_links:
+            path_links[n1, n2] = path_links[n2, n1] = get_path_links(objs)
+    topology.graph["ksp"] = ksp
+    topology.graph["ksp_links"] = path_links
+
+
+# hits and misses of the k-shortest-path cache in this process
+ksp_cache_stats = {'hits': 0, 'misses': 0}
+KSP_CACHE_VERSION = 1
+
+
+def get_ksp_cache_file(folder, topology_file, k, weight=None, backend='networkx', disjoint=False):
+    """
+    Returns the cache file of the k shortest paths, addressed by the content of the topology file (or the spec of a
+    synthetic topology), k, the weight, and the backend and disjoint settings if they are not the default ones.
+    """
+    digest = hashlib.sha256()
+    if is_synthetic_topology(topology_file):
+        digest.update(topology_file.encode())
+    else:
+        with open(topology_file, 'rb') as file:
+            digest.update(file.read())
+    digest.update(f'|k={k}|weight={weight}|version={KSP_CACHE_VERSION}'.encode())
+    if backend != 'networkx' or disjoint:  # the files of the default settings keep their former names
+        digest.update(f'|backend={backend}|disjoint={disjoint}'.encode())
+    name = get_topology_name(topology_file)
+    return os.path.join(folder, f'ksp_{name}_{digest.hexdigest()[:20]}.npz')
+
+
+def flatten_k_shortest_paths(topology, k_shortest_paths):
+    """
+    Converts the paths into flat arrays: nodes and links are stored by their position in
+    topology.graph['node_indices'] and by their edge index, respectively.
+    Only one direction of each node pair is stored.
+    """
+    node_position = {node: idx for idx, node in enumerate(topology.graph['node_indices'])}
+    pairs, path_offsets, node_offsets, path_nodes, path_edges, lengths = [], [0], [0], [], [], []
+    for (n1, n2), objs in k_shortest_paths.items():
+        if node_position[n1] > node_position[n2] and (n2, n1) in k_shortest_paths:
+            continue
+        pairs.append((node_position[n1], node_position[n2]))
+        for path in objs:
+            path_nodes.extend(node_position[node] for node in path.node_list)
+            path_edges.extend(path.edge_indices)
+            node_offsets.append(len(path_nodes))
+            lengths.append(path.length)
+        path_offsets.append(len(lengths))
+    return {'node_indices': np.array(topology.graph['node_indices'], dtype=str),
+            'pairs': np.array(pairs, dtype=np.int32).reshape(-1, 2),
+            'path_offsets': np.array(path_offsets, dtype=np.int64),
+            'node_offsets': np.array(node_offsets, dtype=np.int64),
+            'path_nodes': np.array(path_nodes, dtype=np.int32),
+            'path_edges': np.array(path_edges, dtype=np.int32),
+            'lengths': np.array(lengths, dtype=float)}
+
+
+def unflatten_k_shortest_paths(topology, arrays):
+    """
+    Builds the paths from the arrays of flatten_k_shortest_paths(). The edge indices of the paths are views of
+    arrays['path_edges']. Returns a dict (n1, n2) -> list of Path.
+    """
+    if list(arrays['node_indices']) != list(topology.graph['node_indices']):
+        raise ValueError('The k-shortest-path arrays do not match the nodes of the topology')
+    path_offsets = arrays['path_offsets']
+    node_offsets = arrays['node_offsets']
+    path_nodes = arrays['path_nodes']
+    path_edges = arrays['path_edges']
+    lengths = arrays['lengths']
+    nodes = topology.graph['node_indices']
     k_shortest_paths = {}
-    if args.topology_file.endswith(".xml"):
-        topology = read_sndlib_topology(args.topology_file)
+    for idx, (n1, n2) in enumerate(arrays['pairs']):
+        objs = []
+        for idp in range(path_offsets[idx], path_offsets[idx + 1]):
+            start, end = node_offsets[idp], node_offsets[idp + 1]
+            # a path with m nodes has m - 1 links, hence the offsets of the links are shifted by the path number
+            objs.append(Path([nodes[n] for n in path_nodes[start:end]], lengths[idp],
+                             edge_indices=path_edges[start - idp:end - idp - 1]))
+        k_shortest_paths[nodes[n1], nodes[n2]] = objs
+    return k_shortest_paths
+
+
+def save_ksp_cache(file, topology, k_shortest_paths):
+    os.makedirs(os.path.dirname(file) or '.', exist_ok=True)
+    temporary_file = file + '.tmp.npz'
+    np.savez(temporary_file, **flatten_k_shortest_paths(topology, k_shortest_paths))
+    os.replace(temporary_file, file)  # the cache file appears atomically
+
+
+def load_ksp_cache(file, topology):
+    """
+    Loads the paths saved by save_ksp_cache(). Returns a dict (n1, n2) -> list of Path.
+    """
+    with np.load(file) as data:
+        arrays = {key: data[key] for key in data.files}
+    return unflatten_k_shortest_paths(topology, arrays)
+
+
+class SharedTopology:
+    """
+    Places the k-shortest-path tables of a topology in shared memory, so that they are sent only once to the
+    processes running the simulations. Only the names of the shared blocks and a copy of the graph without the
+    paths are pickled. The process that creates the object must call unlink() when the simulations are done.
+    With lazy paths (see set_lazy_k_shortest_paths), nothing is shared: each process computes the paths it uses.
+    """
+    def __init__(self, topology):
+        self.specs = {}
+        self.blocks = {}
+        if isinstance(topology.graph['ksp'], LazyPathView):
+            self.graph = topology.copy()
+            return
+        arrays = flatten_k_shortest_paths(topology, topology.graph['ksp'])
+        # the link tables of the pairs, one after the other, with the offset of each one
+        tables = [get_path_links(topology.graph['ksp'][tuple(topology.graph['node_indices'][n] for n in pair)])
+                  for pair in arrays['pairs']]
+        arrays['path_links'] = np.concatenate([table.ravel() for table in tables]) if len(tables) > 0 \
+            else np.zeros(0, dtype=np.int64)
+        arrays['link_offsets'] = np.cumsum([0] + [table.size for table in tables], dtype=np.int64)
+        self.graph = topology.copy()
+        del self.graph.graph['ksp']
+        self.graph.graph.pop('ksp_links', None)
+        for key, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks[key] = block
+            self.specs[key] = (block.name, array.shape, array.dtype.str)
+
+    def __getstate__(self):
+        return {'graph': self.graph, 'specs': self.specs}
+
+    def __setstate__(self, state):
+        self.graph = state['graph']
+        self.specs = state['specs']
+        self.blocks = {}
+
+    def attach(self):
+        """
+        Returns a topology whose paths, edge indices and link tables are views of the shared memory.
+        """
+        if len(self.specs) == 0:
+            return self.graph.copy()  # lazy paths
+        arrays = {}
+        for key, (name, shape, dtype) in self.specs.items():
+            if key not in self.blocks:
+                self.blocks[key] = shared_memory.SharedMemory(name=name)
+            arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.blocks[key].buf)
+        topology = self.graph.copy()
+        k_shortest_paths = unflatten_k_shortest_paths(topology, arrays)
+        path_links = {}
+        for idx, (n1, n2) in enumerate(k_shortest_paths):
+            paths = k_shortest_paths[n1, n2]
+            links = arrays['path_links'][arrays['link_offsets'][idx]:arrays['link_offsets'][idx + 1]]
+            path_links[n1, n2] = path_links[n2, n1] = \
+                links.reshape(len(paths), max([path.hops for path in paths], default=1))
+        set_k_shortest_paths(topology, k_shortest_paths, path_links=path_links)
+        return topology
+
+    def unlink(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+
+def get_topology(args):
+    """
+    Reads the topology args.topology_file (see read_topology) and sets its k shortest paths, computed with the
+    backend args.ksp_backend (link-disjoint if args.ksp_disjoint is set). If args.lazy_ksp is set, the paths of
+    each node pair are computed when first used and the ones of the last args.lazy_ksp pairs are kept
+    (0 keeps all of them), in which case the cache is not used.
+    """
+    topology = read_topology(args.topology_file)
+    if is_synthetic_topology(args.topology_file):
+        topology_path = args.topology_file  # the cache is addressed by the spec of the topology
     else:
-        raise ValueError("Supplied topology is unknown")
+        topology_path = get_topology_path(args.topology_file)
 
-    for idn1, n1 in enumerate(topology.nodes()):
-        for idn2, n2 in enumerate(topology.nodes()):
-            if idn1 < idn2:
-                paths = get_k_shortest_paths(topology, n1, n2, args.k_paths)
-                lengths = [get_path_weight(topology, path) for path in paths]
-                objs = []
-                for path, length in zip(paths, lengths):
-                    objs.append(Path(path, length))
-                # both directions have the same paths, i.e., bidirectional symetrical links
-                k_shortest_paths[n1, n2] = objs
-                k_shortest_paths[n2, n1] = objs
-    topology.graph["ksp"] = k_shortest_paths
-    return topology
\ No newline at end of file
+    weight = args.ksp_weight if hasattr(args, 'ksp_weight') else None
+    cache_folder = args.ksp_cache_folder if hasattr(args, 'ksp_cache_folder') else None
+    rebuild = args.rebuild_ksp_cache if hasattr(args, 'rebuild_ksp_cache') else False
+    processes = args.threads if hasattr(args, 'threads') else 1
+    backend = args.ksp_backend if hasattr(args, 'ksp_backend') and args.ksp_backend is not None else 'networkx'
+    disjoint = args.ksp_disjoint if hasattr(args, 'ksp_disjoint') else False
+    lazy = args.lazy_ksp if hasattr(args, 'lazy_ksp') else None
+
+    if lazy is not None:
+        set_lazy_k_shortest_paths(topology, args.k_paths, weight=weight, backend=backend, disjoint=disjoint,
+                                  maxsize=lazy if lazy > 0 else None)
+        return topology
+    if not cache_folder:
+        k_shortest_paths = compute_k_shortest_paths(topology, args.k_paths, weight=weight, processes=processes,
+                                                    backend=backend, disjoint=disjoint)
+    else:
+        cache_file = get_ksp_cache_file(cache_folder, topology_path, args.k_paths, weight, backend, disjoint)
+        if os.path.isfile(cache_file) and not rebuild:
+            k_shortest_paths = load_ksp_cache(cache_file, topology)
+            ksp_cache_stats['hits'] += 1
+            logging.debug(f'loaded k-shortest paths from cache {cache_file}')
+        else:
+            k_shortest_paths = compute_k_shortest_paths(topology, args.k_paths, weight=weight, processes=processes,
+                                                        backend=backend, disjoint=disjoint)
+            save_ksp_cache(cache_file, topology, k_shortest_paths)
+            ksp_cache_stats['misses'] += 1
+            logging.debug(f'saved k-shortest paths to cache {cache_file}')
+    set_k_shortest_paths(topology, k_shortest_paths)
+    return topology
@@ -0,0 +1,300 @@
+import numpy as np
+
+
+# path tables of the last topology used in this process, see get_path_tables()
+_path_tables = {}
+
+
+def get_path_tables(topology):
+    """
+    Returns the k shortest paths of every ordered node pair as arrays indexed by pair = source index * N +
+    destination index: the links of each path padded with the dummy link E (shape pairs x k x maximum hops), their
+    number of hops, and whether each of the k paths exists. The tables are kept for the paths of the last topology.
+    """
+    ksp = topology.graph['ksp']
+    if _path_tables.get('ksp') is ksp:
+        return _path_tables['tables']
+    nodes = topology.graph['node_indices']
+    num_nodes, num_links = len(nodes), topology.number_of_edges()
+    pairs = {}
+    for idn1, n1 in enumerate(nodes):
+        for idn2, n2 in enumerate(nodes):
+            if idn1 != idn2:
+                pairs[idn1 * num_nodes + idn2] = ksp[n1, n2]
+    k = max(len(paths) for paths in pairs.values())
+    max_hops = max(path.hops for paths in pairs.values() for path in paths)
+    path_links = np.full((num_nodes * num_nodes, k, max_hops), num_links, dtype=np.int64)
+    hops = np.zeros((num_nodes * num_nodes, k), dtype=np.int64)
+    exists = np.zeros((num_nodes * num_nodes, k), dtype=bool)
+    for pair, paths in pairs.items():
+        for idp, path in enumerate(paths):
+            path_links[pair, idp, :path.hops] = path.edge_indices
+            hops[pair, idp] = path.hops
+            exists[pair, idp] = True
+    _path_tables.clear()
+    _path_tables.update(ksp=ksp, tables=(path_links, hops, exists))
+    return path_links, hops, exists
+
+
+class LockstepSimulation:
+    """
+    Runs the simulations of several seeds of the configuration of env in lockstep: the i-th arrival of all the seeds
+    is routed at once, with the state of the links of all the seeds in (seeds x links) arrays, after releasing the
+    services of each seed that depart before it, in the order of their departure. The arrivals are drawn in blocks
+    of block_size per seed with the generators of the event engine, and each seed reports the same records as
+    core.run_simulation(), i.e., the same arrivals, routing decisions and statistics, including warm-up and batches.
+    The policy must implement RoutingPolicy.select_paths(). There are no progress plots and no service history.
+    """
+    def __init__(self, env, seeds, block_size=1024):
+        self.env = env
+        self.seeds = [seed for seed, _ in seeds]  # (id_simulation, seed of the simulation)
+        self.simulation_seeds = [simulation_seed for _, simulation_seed in seeds]
+        self.block_size = block_size
+        self.path_links, self.hops, self.exists = get_path_tables(env.topology)
+        self.num_nodes = env.topology.number_of_nodes()
+        self.num_links = env.topology.number_of_edges()
+        self.units = env.resource_units_per_link
+        self.total_units = self.units * self.num_links
+
+    def run(self):
+        env = self.env
+        num_seeds, num_links = len(self.seeds), self.num_links
+        rows = np.arange(num_seeds)
+        self.generators = [env.get_traffic_generator(seed=seed) for seed in self.simulation_seeds]
+        # the last column is a dummy link, used to pad the paths, which always has units available
+        self.available = np.full((num_seeds, num_links + 1), self.units, dtype=np.int64)
+        self.available[:, num_links] = np.iinfo(np.int64).max // 2
+        self.utilization = np.zeros((num_seeds, num_links + 1))
+        self.last_update = np.zeros((num_seeds, num_links + 1))
+        self.current_time = np.zeros(num_seeds)
+        self.rejected = np.zeros(num_seeds, dtype=np.int64)
+        self.used_units = np.zeros(num_seeds, dtype=np.int64)
+        self.usage_integral = np.zeros(num_seeds)
+        self.last_network_update = np.zeros(num_seeds)
+        self.stats_start_time = np.zeros(num_seeds)
+        self.stats_start_rejected = np.zeros(num_seeds, dtype=np.int64)
+        self.stats_start_arrivals = 0
+        self.batch = 0
+        if env.warmup_arrivals > 0:
+            self.next_restart = env.warmup_arrivals
+        elif env.num_batches > 0:
+            self.next_restart = env._get_batch_end(0)
+        else:
+            self.next_restart = -1
+        total_arrivals = env.warmup_arrivals + env.num_arrivals + 1
+        self.tracked = {obs: np.zeros((num_seeds, total_arrivals // env.track_stats_every))
+                        for obs in env.tracked_statistics}
+        self.tracked_samples = 0
+        env._simulation_records = []
+
+        # departures of the services still running, with their seed, time, links, units and hops
+        pending = (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, self.path_links.shape[2]), dtype=np.int64),
+                   np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        last_arrival = np.zeros(num_seeds)
+        self._after_arrival(0)
+        processed = 0
+        while processed < total_arrivals:
+            size = min(self.block_size, total_arrivals - processed)
+            inter_arrival_times, holding_times, sources, destinations, units = self._draw(size)
+            # arrival times accumulated one by one, as the clock of the event engine
+            times = np.cumsum(np.concatenate([last_arrival[:, None], inter_arrival_times], axis=1), axis=1)[:, 1:]
+            last_arrival = times[:, -1]
+
+            # the departures are stored after the pending ones: row len(pending) + seed * size + arrival
+            num_pending = len(pending[0])
+            seed_of = np.concatenate([pending[0], np.repeat(rows, size)])
+            departure = np.concatenate([pending[1], (times + holding_times).ravel()])
+            links = np.concatenate([pending[2], np.zeros((num_seeds * size, self.path_links.shape[2]), dtype=np.int64)])
+            service_units = np.concatenate([pending[3], units.ravel()])
+            service_hops = np.concatenate([pending[4], np.zeros(num_seeds * size, dtype=np.int64)])
+            provisioned = np.concatenate([np.ones(num_pending, dtype=bool), np.zeros(num_seeds * size, dtype=bool)])
+
+            # arrival before which each service departs (size if after the block); ties go to the departure
+            release_step = np.empty(len(departure), dtype=np.int64)
+            order = np.lexsort((departure, seed_of))
+            bounds = np.searchsorted(seed_of[order], np.arange(num_seeds + 1))
+            for seed in range(num_seeds):
+                selected = order[bounds[seed]:bounds[seed + 1]]
+                release_step[selected] = np.searchsorted(times[seed], departure[selected], side='left')
+            rounds = self._get_rounds(release_step, seed_of, departure)
+
+            pairs = sources * self.num_nodes + destinations
+            for i in range(size):
+                for release in rounds.get(i, []):
+                    release = release[provisioned[release]]
+                    self._release(seed_of[release], departure[release], links[release], service_units[release],
+                                  service_hops[release])
+                store = num_pending + rows * size + i
+                choice, selected_links, selected_hops = self._route(pairs[:, i], units[:, i])
+                accepted = choice >= 0
+                tau = times[:, i]
+                self.current_time[:] = tau
+                self.rejected += ~accepted
+                if accepted.any():
+                    seeds = rows[accepted]
+                    self._allocate(seeds, tau[accepted], selected_links[accepted], units[accepted, i],
+                                   selected_hops[accepted])
+                    links[store[accepted]] = selected_links[accepted]
+                    service_hops[store[accepted]] = selected_hops[accepted]
+                    provisioned[store[accepted]] = True
+                processed += 1
+                self._after_arrival(processed)
+
+            keep = (release_step == size) & provisioned
+            pending = (seed_of[keep], departure[keep], links[keep], service_units[keep], service_hops[keep])
+
+        # the remaining services depart after the last arrival
+        for release in self._get_rounds(np.zeros(len(pending[0]), dtype=np.int64), pending[0], pending[1]).get(0, []):
+            self._release(pending[0][release], pending[1][release], pending[2][release], pending[3][release],
+                          pending[4][release])
+        if env.num_batches == 0:
+            for idx in range(num_seeds):
+                env._send_record(self._get_record(idx, self.seeds[idx], processed, tracked_results=True))
+
+    def _draw(self, size):
+        """
+        Draws the next size arrivals of each seed. Returns (seeds x size) arrays as TrafficGenerator.draw_block().
+        """
+        blocks = []
+        for generator in self.generators:
+            if hasattr(generator, 'draw_block'):
+                blocks.append(generator.draw_block(size))
+            else:
+                blocks.append([np.array(values) for values in zip(*[generator.next() for _ in range(size)])])
+        return [np.stack(arrays) for arrays in zip(*blocks)]
+
+    @staticmethod
+    def _get_rounds(release_step, seed_of, departure):
+        """
+        Groups the departures by the arrival before which they are released, and in rounds with at most one departure
+        of each seed, in the order of their departure time. Returns dict step -> list of arrays of rows.
+        """
+        rounds = {}
+        if len(release_step) == 0:
+            return rounds
+        order = np.lexsort((departure, seed_of, release_step))
+        # rank of each departure among the ones of its seed released before the same arrival
+        group = np.r_[True, (release_step[order][1:] != release_step[order][:-1]) |
+                      (seed_of[order][1:] != seed_of[order][:-1])]
+        starts = np.flatnonzero(group)
+        rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+        by_round = np.lexsort((rank, release_step[order]))  # stable, hence the seeds stay in order within a round
+        order, rank = order[by_round], rank[by_round]
+        steps = release_step[order]
+        boundaries = np.flatnonzero(np.r_[True, (steps[1:] != steps[:-1]) | (rank[1:] != rank[:-1]), True])
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            rounds.setdefault(int(steps[start]), []).append(order[start:end])
+        return rounds
+
+    def _route(self, pairs, units):
+        """
+        Evaluates the k paths of the arrival of each seed and selects one with the policy (-1 rejects it).
+        Returns the selected path of each seed, its links and its hops.
+        """
+        path_links = self.path_links[pairs]
+        available = self.available[np.arange(len(pairs))[:, None, None], path_links]
+        feasible = self.exists[pairs] & (available >= units[:, None, None]).all(axis=2)
+        max_usage = (self.units - available).max(axis=2)  # the dummy link has a negative usage
+        choice = self.env.policy.select_paths(feasible, max_usage)
+        selected = np.maximum(choice, 0)
+        return choice, path_links[np.arange(len(pairs)), selected], self.hops[pairs, selected]
+
+    def _allocate(self, seeds, tau, links, units, hops):
+        index = (seeds * (self.num_links + 1))[:, None] + links  # in the flattened (seeds x links) arrays
+        self.available.ravel()[index] -= units[:, None]
+        self._update_link_stats(seeds, index, tau)
+        self._update_network_stats(seeds, tau, units * hops)
+
+    def _release(self, seeds, tau, links, units, hops):
+        index = (seeds * (self.num_links + 1))[:, None] + links
+        self.available.ravel()[index] += units[:, None]
+        self._update_link_stats(seeds, index, tau)
+        self._update_network_stats(seeds, tau, -units * hops)
+        self.current_time[seeds] = tau
+
+    def _update_link_stats(self, seeds, index, tau):
+        """
+        Time-weighted utilization of the links with the given indices in the flattened (seeds x links) arrays, as
+        LinkState.update_stats().
+        """
+        utilization, last_update = self.utilization.ravel(), self.last_update.ravel()
+        previous, previous_update = utilization[index], last_update[index]
+        start_time = self.stats_start_time[seeds][:, None]
+        tau = tau[:, None]
+        cur_util = (self.units - self.available.ravel()[index]) / self.units
+        # utilization is weighted by the time, and kept if no time passed since the start of the statistics
+        utilization[index] = np.divide((previous * (previous_update - start_time)) + (cur_util * (tau - previous_update)),
+                                       tau - start_time, out=previous, where=tau > start_time)
+        last_update[index] = tau
+
+    def _update_network_stats(self, seeds, tau, used_units_change):
+        self.usage_integral[seeds] += self.used_units[seeds] * (tau - self.last_network_update[seeds])
+        self.last_network_update[seeds] = tau
+        self.used_units[seeds] += used_units_change
+
+    def _after_arrival(self, processed):
+        """
+        Ends the warm-up or the current batch, and tracks the statistics, as Environment.setup_next_arrival() after
+        the processed-th arrival of all the seeds.
+        """
+        env = self.env
+        if processed == self.next_restart:
+            self._end_period(processed)
+        if processed > env.warmup_arrivals + env.num_arrivals:
+            return
+        if (processed + 1) % env.track_stats_every == 0:
+            self.tracked['request_blocking_ratio'][:, self.tracked_samples] = \
+                (self.rejected - self.stats_start_rejected) / float(processed + 1 - self.stats_start_arrivals)
+            self.tracked['average_link_usage'][:, self.tracked_samples] = self.used_units / self.total_units
+            self.tracked_samples += 1
+
+    def _end_period(self, processed):
+        env = self.env
+        rows = np.arange(len(self.seeds))
+        if processed > env.warmup_arrivals:
+            # brings the statistics of all the links up to the current time
+            all_links = (rows * (self.num_links + 1))[:, None] + np.arange(self.num_links)
+            self._update_link_stats(rows, all_links, self.current_time)
+            last_batch = self.batch == env.num_batches - 1
+            for idx in rows:
+                env._send_record(self._get_record(idx, self.seeds[idx] * env.num_batches + self.batch, processed,
+                                                  tracked_results=last_batch))
+            self.batch += 1
+        # restarts the statistics
+        self.stats_start_time = self.current_time.copy()
+        self.stats_start_arrivals = processed
+        self.stats_start_rejected = self.rejected.copy()
+        self.usage_integral[:] = 0.0
+        self.last_network_update = self.current_time.copy()
+        self.utilization[:] = 0.0
+        self.last_update[:] = self.current_time[:, None]
+        if env.num_batches > 0 and self.batch < env.num_batches:
+            self.next_restart = env._get_batch_end(self.batch)
+        else:
+            self.next_restart = -1
+
+    def _get_record(self, idx, id_simulation, processed, tracked_results):
+        """
+        Record of the idx-th seed, as Environment.get_simulation_record().
+        """
+        env = self.env
+        individual_link_usage = self.utilization[idx, env._edge_order].tolist()
+        current_time, start_time = self.current_time[idx], self.stats_start_time[idx]
+        if current_time <= start_time:
+            network_utilization = 0.0
+        else:
+            usage_integral = self.usage_integral[idx] + self.used_units[idx] * (current_time - self.last_network_update[idx])
+            network_utilization = float(usage_integral / ((current_time - start_time) * self.total_units))
+        return {
+            'policy': env.policy.name,
+            'load': env.load,
+            'id_simulation': id_simulation,
+            'seed': self.simulation_seeds[idx],
+            'request_blocking_ratio': float(self.rejected[idx] - self.stats_start_rejected[idx]) /
+            float(processed - self.stats_start_arrivals),
+            'average_link_usage': np.mean(individual_link_usage),
+            'individual_link_usage': individual_link_usage,
+            'network_utilization': network_utilization,
+            'tracked_results': {obs: values[idx, :self.tracked_samples].tolist() for obs, values in self.tracked.items()}
+            if tracked_results else {}
+        }
@@ -11,65 +11,100 @@ from matplotlib import rcParams
 import matplotlib.pyplot as plt
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
 
+from results import ResultsTable
+
 
 def plot_simulation_progress(env):
     """
     Plots results for a particular configuration.
     """
+    plot_progress_record(env.get_progress_record())
+
+
+def plot_progress_record(record):
+    """
+    Plots the tracked statistics of a particular configuration, as returned by Environment.get_progress_record().
+    """
+    tracked_results = record['tracked_results']
+    track_stats_every = record['track_stats_every']
     plt.figure(figsize=(10, 4))
 
     plt.subplot(1, 2, 1)
-    if any(i > 0 for i in env.tracked_results['request_blocking_ratio']):
-        plt.semilogy([x * env.track_stats_every for x in range(1, len(env.tracked_results['request_blocking_ratio'])+1)],
-                 env.tracked_results['request_blocking_ratio'])
+    if any(i > 0 for i in tracked_results['request_blocking_ratio']):
+        plt.semilogy([x * track_stats_every for x in range(1, len(tracked_results['request_blocking_ratio'])+1)],
+                 tracked_results['request_blocking_ratio'])
     plt.xlabel('Arrival')
     plt.ylabel('Req. blocking ratio')
 
     plt.subplot(1, 2, 2)
-    plt.plot([x * env.track_stats_every for x in range(1, len(env.tracked_results['average_link_usage'])+1)],
-                 env.tracked_results['average_link_usage'])
+    plt.plot([x * track_stats_every for x in range(1, len(tracked_results['average_link_usage'])+1)],
+                 tracked_results['average_link_usage'])
     plt.xlabel('Arrival')
     plt.ylabel('Avg. link usage')
 
     plt.tight_layout()
     # plt.show()
-    for format in env.plot_formats:
-        plt.savefig('./results/{}/progress_{}_{}_{}.{}'.format(env.output_folder,
-                                                               env.policy.name, env.load, env.id_simulation, format))
+    for format in record['plot_formats']:
+        plt.savefig('./results/{}/progress_{}_{}_{}.{}'.format(record['output_folder'],
+                                                               record['policy'], record['load'],
+                                                               record['id_simulation'], format))
     plt.close()
 
 
+def plotting_process(queue):
+    """
+    Plots the progress records sent by the simulations until a None is received.
+    Records waiting in the queue for the same simulation are merged, and only the most recent one is plotted.
+    """
+    finished = False
+    while not finished:
+        pending = {}
+        record = queue.get()
+        while True:
+            if record is None:
+                finished = True
+            else:
+                pending[record['policy'], record['load'], record['id_simulation']] = record
+            if finished or queue.empty():
+                break
+            record = queue.get()
+        for record in pending.values():
+            plot_progress_record(record)
+
+
 def plot_final_results(env, results, start_time, savefile=True, show=False, timedelta=None):
     """
     Consolidates the statistics and plots it periodically and at the end of all simulations.
     """
     markers = ['', 'x']
+    # the means of each policy and load are computed at once over the columns of the records
+    table = ResultsTable.from_results(results)
+    blocking = table.aggregate('request_blocking_ratio', by=('policy', 'load'))
+    usage = table.aggregate('average_link_usage', by=('policy', 'load'))
 
     plt.figure(figsize=(10, 4))
     plt.subplot(1, 2, 1)
     for idp, policy in enumerate(results):
-        if any(results[policy][load][x]['request_blocking_ratio'] > 0 for load in results[policy] for x in range(len(results[policy][load]))):
-            plt.semilogy([load for load in results[policy]],
-            [np.mean([results[policy][load][x]['request_blocking_ratio'] for x in range(len(results[policy][load]))])
-             for load in results[policy]], label=policy, marker=markers[idp])
+        if np.any(table['request_blocking_ratio'][table['policy'] == policy] > 0):
+            plt.semilogy(blocking['load'][blocking['policy'] == policy], blocking['mean'][blocking['policy'] == policy],
+                         label=policy, marker=markers[idp])
     plt.xlabel('Load [Erlang]')
     plt.ylabel('Req. blocking ratio')
 
     plt.subplot(1, 2, 2)
     has_data = False
     for idp, policy in enumerate(results):
-        if any(results[policy][load][x]['average_link_usage'] > 0 for load in results[policy] for x in range(len(results[policy][load]))):
+        if np.any(table['average_link_usage'][table['policy'] == policy] > 0):
             has_data = True
-            plt.plot([load for load in results[policy]],
-                [np.mean([results[policy][load][x]['average_link_usage'] for x in range(len(results[policy][load]))]) for
-                load in results[policy]], label=policy, marker=markers[idp])
+            plt.plot(usage['load'][usage['policy'] == policy], usage['mean'][usage['policy'] == policy], label=policy,
+                     marker=markers[idp])
     plt.xlabel('Load [Erlang]')
     plt.ylabel('Avg. link usage')
     if has_data:
         plt.legend(loc=2)
 
     total_simulations = np.sum([1 for p in results for l in results[p]]) * env.num_seeds
-    performed_simulations = np.sum([len(results[p][l]) for p in results for l in results[p]])
+    performed_simulations = len(table)
     percentage_completed = float(performed_simulations) / float(total_simulations) * 100.
 
     plt.tight_layout()
@@ -89,4 +124,27 @@ def plot_final_results(env, results, start_time, savefile=True, show=False, time
             plt.savefig('./results/{}/final_results.{}'.format(env.output_folder, format))
     if show:
         plt.show()
-    plt.close()
\ No newline at end of file
+    plt.close()
+
+
+if __name__ == '__main__':
+    # plots the progress of every simulation and the final results from the results of a finished run
+    import argparse
+    import results
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('folder', help='Folder containing the final_results.npz file')
+    parser.add_argument('-f', '--formats', nargs='+', default=['pdf'], help='Formats of the plots (default=pdf)')
+    args = parser.parse_args()
+
+    data = results.load_results(f'{args.folder}/final_results.npz')
+    env = data['env']
+    env.plot_formats = args.formats
+    for policy in data['results']:
+        for load in data['results'][policy]:
+            for result in data['results'][policy][load]:
+                plot_progress_record({'policy': policy, 'load': load, 'id_simulation': result['id_simulation'],
+                                      'track_stats_every': env.track_stats_every,
+                                      'tracked_results': result['tracked_results'],
+                                      'output_folder': env.output_folder, 'plot_formats': args.formats})
+    plot_final_results(env, data['results'], None, timedelta=data['timedelta'])
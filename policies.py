@@ -12,6 +12,28 @@ class RoutingPolicy(abc.ABC):
     def route(self, service, paths):
         pass
 
+    def route_batch(self, service, paths, feasible, max_usage):
+        """
+        Selects a path given the evaluation of all candidate paths at once, as computed by evaluate_paths().
+        Policies that implement it are used with the link-state arrays without looping over the paths.
+        """
+        raise NotImplementedError
+
+    def select_paths(self, feasible, max_usage):
+        """
+        Selects the paths of many services at once, e.g., of the services arriving in several simulations run in
+        lockstep (see lockstep.py), given (services x k) arrays with the feasibility and the maximum link usage of
+        their paths. Returns the index of the path selected for each service, or -1 if it is rejected.
+        """
+        raise NotImplementedError
+
+    def evaluate_paths(self, service, max_usage=True):
+        """
+        Returns the feasibility and the maximum link usage of all the k paths of the service's node pair
+        """
+        path_links = self.env.topology.graph['ksp_links'][service.source, service.destination]
+        return self.env.link_state.evaluate_paths(path_links, service.number_units, max_usage=max_usage)
+
 
 class ShortestAvailablePath(RoutingPolicy):
 
@@ -23,11 +45,21 @@ class ShortestAvailablePath(RoutingPolicy):
         """
         Remember that this function considers that the list of paths is ordered by distance, i.e., first path is shortest
         """
+        if self.env.link_state is not None:
+            return self.route_batch(service, paths, *self.evaluate_paths(service, max_usage=False))
         for idp, path in enumerate(paths):
-            if is_path_free(self.env.topology, path, service.number_units):
+            if is_path_free(self.env.topology, path, service.number_units, link_state=self.env.link_state):
                 return True, idp
         return False, self.env.k_paths  # returns false and an index out of bounds if no path is available
 
+    def route_batch(self, service, paths, feasible, max_usage):
+        if feasible.any():
+            return True, int(feasible.argmax())  # first feasible path
+        return False, self.env.k_paths
+
+    def select_paths(self, feasible, max_usage):
+        return np.where(feasible.any(axis=1), feasible.argmax(axis=1), -1)
+
 
 class LoadBalancing(RoutingPolicy):
 
@@ -39,29 +71,44 @@ class LoadBalancing(RoutingPolicy):
         """
         Implements load balacing, i.e., selects the path that has the minimum usage.
         """
+        if self.env.link_state is not None:
+            return self.route_batch(service, paths, *self.evaluate_paths(service))
         selected_path = self.env.k_paths  # initialize the path to an out of bounds, i.e., non-existent
         least_load = np.finfo(0.0).max  # initializes load to the maximum value of a float
         for idp, path in enumerate(paths):
-            if is_path_free(self.env.topology, path, service.number_units) and \
-                    get_max_usage(self.env.topology, path) < least_load:
-                least_load = get_max_usage(self.env.topology, path)
+            if is_path_free(self.env.topology, path, service.number_units, link_state=self.env.link_state) and \
+                    get_max_usage(self.env.topology, path, link_state=self.env.link_state) < least_load:
+                least_load = get_max_usage(self.env.topology, path, link_state=self.env.link_state)
                 selected_path = idp
         return selected_path < self.env.k_paths, selected_path
 
+    def route_batch(self, service, paths, feasible, max_usage):
+        if feasible.any():
+            # argmin returns the first path among the ones with the least usage, as in route()
+            return True, int(np.argmin(np.where(feasible, max_usage, np.inf)))
+        return False, self.env.k_paths
+
+    def select_paths(self, feasible, max_usage):
+        return np.where(feasible.any(axis=1), np.argmin(np.where(feasible, max_usage, np.inf), axis=1), -1)
+
 
 # below we have the helper functions
 
-def is_path_free(topology, path, number_units):
+def is_path_free(topology, path, number_units, link_state=None):
+    if link_state is not None:
+        return link_state.is_path_free(path, number_units)
     for i in range(len(path.node_list) - 1):
         if topology[path.node_list[i]][path.node_list[i + 1]]['available_units'] < number_units:
             return False
     return True
 
 
-def get_max_usage(topology, path):
+def get_max_usage(topology, path, link_state=None):
     """
     Obtains the maximum usage of resources among all the links forming the path
     """
+    if link_state is not None:
+        return link_state.get_max_usage(path)
     max_usage = np.finfo(0.0).min
     for i in range(len(path.node_list) - 1):
         max_usage = max(max_usage, topology[path.node_list[i]][path.node_list[i + 1]]['total_units'] - topology[path.node_list[i]][path.node_list[i + 1]]['available_units'])
@@ -0,0 +1,126 @@
+import json
+import time
+
+
+class SimulationProfiler:
+    """
+    Instrumentation of the simulations of one environment, used by core.run_simulation() when env.profile is set.
+    It records the number and the cumulative time of the events of each function and of the calls to the policy's
+    route(), samples the size of the event queue every sample_every events, and measures the time spent in the
+    statistics and in the progress plots. When env.profile is not set, the simulation loop is not instrumented at all.
+    """
+    def __init__(self, env, sample_every=1000):
+        self.env = env
+        self.sample_every = sample_every
+        self.profile = {
+            'policy': env.policy.name,
+            'load': env.load,
+            'seeds': [],
+            'events': {},  # function name -> {'count', 'seconds'}, including the routing and the periodic plots
+            'route': {'count': 0, 'seconds': 0.0},
+            'heap': {'max_size': 0, 'samples': {}},  # samples[id_simulation] = [[events, time, size], ...]
+            'time': {'simulation': 0.0, 'plots': 0.0, 'stats': 0.0},  # the plots are excluded from the others
+        }
+
+    def _timed(self, function, counters):
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            counters['seconds'] += time.perf_counter() - start
+            counters['count'] += 1
+            return result
+        return timed_function
+
+    def run(self):
+        """
+        Processes all the events of the current simulation and computes its statistics, as in run_simulation().
+        """
+        env = self.env
+        plots = {'count': 0, 'seconds': 0.0}
+        # the instance attributes shadow the methods only during this simulation
+        env.policy.route = self._timed(env.policy.route, self.profile['route'])
+        env.plot_progress = self._timed(env.plot_progress, plots)
+        try:
+            counts = [0] * len(env._event_calls)
+            seconds = [0.0] * len(env._event_calls)
+            samples = []
+            processed = 0
+            max_size = 0
+            start_events = time.perf_counter()
+            while len(env.events) > 0:
+                kind = env.events[0][2]
+                start = time.perf_counter()
+                env.process_next_event()
+                elapsed = time.perf_counter() - start
+                if kind >= len(counts):  # functions other than arrival and departure
+                    counts.extend([0] * (kind + 1 - len(counts)))
+                    seconds.extend([0.0] * (kind + 1 - len(seconds)))
+                counts[kind] += 1
+                seconds[kind] += elapsed
+                processed += 1
+                max_size = max(max_size, len(env.events))
+                if processed % self.sample_every == 0:
+                    samples.append([processed, env.current_time, len(env.events)])
+            events_plots = plots['seconds']
+            self.profile['time']['simulation'] += time.perf_counter() - start_events - events_plots
+
+            start = time.perf_counter()
+            env.compute_simulation_stats()
+            self.profile['time']['stats'] += time.perf_counter() - start - (plots['seconds'] - events_plots)
+        finally:
+            del env.policy.route
+            del env.plot_progress
+        self.profile['time']['plots'] += plots['seconds']
+
+        for kind, call in enumerate(env._event_calls[:len(counts)]):
+            counters = self.profile['events'].setdefault(call.__name__, {'count': 0, 'seconds': 0.0})
+            counters['count'] += counts[kind]
+            counters['seconds'] += seconds[kind]
+        self.profile['seeds'].append(env.id_simulation)
+        self.profile['heap']['max_size'] = max(self.profile['heap']['max_size'], max_size)
+        self.profile['heap']['samples'][str(env.id_simulation)] = samples
+
+
+def add_profile(profiles, profile):
+    """
+    Merges the profile of some seeds into profiles[(policy, load)], which then has the profile of the configuration.
+    """
+    key = (profile['policy'], profile['load'])
+    if key not in profiles:
+        profiles[key] = profile
+        return
+    merged = profiles[key]
+    merged['seeds'].extend(profile['seeds'])
+    for name, counters in profile['events'].items():
+        merged_counters = merged['events'].setdefault(name, {'count': 0, 'seconds': 0.0})
+        merged_counters['count'] += counters['count']
+        merged_counters['seconds'] += counters['seconds']
+    merged['route']['count'] += profile['route']['count']
+    merged['route']['seconds'] += profile['route']['seconds']
+    merged['heap']['max_size'] = max(merged['heap']['max_size'], profile['heap']['max_size'])
+    merged['heap']['samples'].update(profile['heap']['samples'])
+    for part, seconds in profile['time'].items():
+        merged['time'][part] += seconds
+
+
+def get_summary(profile):
+    """
+    Adds to a profile the time per call of the events and of route(), and the split of the time between the
+    simulation itself, the progress plots and the statistics.
+    """
+    summary = dict(profile)
+    for counters in list(summary['events'].values()) + [summary['route']]:
+        counters['us_each'] = 1e6 * counters['seconds'] / counters['count'] if counters['count'] > 0 else 0.0
+    total = sum(profile['time'].values())
+    summary['time_fraction'] = {part: seconds / total if total > 0 else 0.0 for part, seconds in profile['time'].items()}
+    summary['time'] = dict(profile['time'], total=total)
+    return summary
+
+
+def save_profiles(folder, profiles):
+    """
+    Writes the summary of the profile of each configuration to <folder>/profile_<policy>_<load>.json.
+    """
+    for (policy, load), profile in profiles.items():
+        with open(f'{folder}/profile_{policy}_{load}.json', 'wt') as file:
+            json.dump(get_summary(profile), file, indent=2)
@@ -0,0 +1,441 @@
+import argparse
+import datetime
+import functools
+import glob
+import json
+import math
+import os
+import queue
+import struct
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import core
+import stats
+
+
+def add_record(results, record):
+    """
+    Adds one record sent by a simulation to the dict results[policy][load] -> list of records.
+    A record with the same id_simulation as an existing one (e.g., sent again by a resumed simulation) replaces it.
+    """
+    records = results.setdefault(record['policy'], {}).setdefault(record['load'], [])
+    cached = _record_indices.get(id(records))
+    if cached is None or cached[0] is not records or cached[2] > len(records):
+        cached = _record_indices[id(records)] = [records, {}, 0]
+    _, index, indexed = cached
+    # records appended to the list without add_record() (e.g., by Environment._send_record) are indexed first
+    for idx in range(indexed, len(records)):
+        index.setdefault(records[idx]['id_simulation'], idx)
+    idx = index.get(record['id_simulation'])
+    if idx is not None:
+        records[idx] = record
+    else:
+        index[record['id_simulation']] = len(records)
+        records.append(record)
+    cached[2] = len(records)
+
+
+# index of the lists of records of add_record(): id(records) -> [records, id_simulation -> position in records, number
+# of records indexed], which keeps a reference to each list so that its id is not reused
+_record_indices = {}
+
+
+def save_record(folder, record):
+    """
+    Saves one record to <folder>/<policy>_<load>_<id_simulation>.json. The file is written under a temporary name
+    and then renamed, so that it is either complete or absent if the process is killed.
+    """
+    file = os.path.join(folder, '{}_{}_{}.json'.format(record['policy'], record['load'], record['id_simulation']))
+    with open(file + '.tmp', 'wt') as output:
+        json.dump(record, output)
+    os.replace(file + '.tmp', file)
+
+
+def load_records(folder):
+    """
+    Returns the list of records saved by save_record() in folder.
+    """
+    records = []
+    for file in sorted(glob.glob(os.path.join(folder, '*.json'))):
+        with open(file, 'rt') as data:
+            records.append(json.load(data))
+    return records
+
+
+def collect_results(results_queue, results, timeout=None, max_records=None, units_folder=None):
+    """
+    Moves the records waiting in results_queue into results, and saves each of them in units_folder if given.
+    Waits up to timeout seconds for the first record (None waits until one arrives, 0 does not wait).
+    Returns the number of records collected.
+    """
+    collected = 0
+    try:
+        record = results_queue.get(timeout=timeout) if timeout != 0 else results_queue.get_nowait()
+        while True:
+            if units_folder is not None:
+                save_record(units_folder, record)
+            add_record(results, record)
+            collected += 1
+            if max_records is not None and collected >= max_records:
+                break
+            record = results_queue.get_nowait()
+    except queue.Empty:
+        pass
+    return collected
+
+
+def get_confidence_intervals(results, confidence=0.95, statistic='request_blocking_ratio'):
+    """
+    Returns ci[policy][load] = (mean, half-width, number of seeds) of the statistic over the seeds.
+    """
+    ci = {}
+    for policy in results:
+        ci[policy] = {}
+        for load in results[policy]:
+            values = [record[statistic] for record in results[policy][load]]
+            ci[policy][load] = stats.confidence_interval(values, confidence) + (len(values),)
+    return ci
+
+
+def get_paired_differences(results, policy, reference, load, statistic='request_blocking_ratio'):
+    """
+    Returns the differences of the statistic between policy and reference at the load, paired by id_simulation,
+    i.e., between the simulations of both policies with the same seed (or batch), in the order of id_simulation.
+    """
+    reference_values = {record['id_simulation']: record[statistic] for record in results[reference].get(load, [])}
+    return [record[statistic] - reference_values[record['id_simulation']]
+            for record in sorted(results[policy].get(load, []), key=lambda r: r['id_simulation'])
+            if record['id_simulation'] in reference_values]
+
+
+def get_paired_confidence_intervals(results, reference=None, confidence=0.95, statistic='request_blocking_ratio'):
+    """
+    Returns ci[policy][load] = (mean, half-width, number of pairs) of the difference of the statistic between each
+    policy and the reference one (the first one by default). Both policies see the same arrivals with the same seed,
+    hence the differences vary much less than the statistic itself, and their intervals need fewer seeds.
+    """
+    reference = list(results)[0] if reference is None else reference
+    ci = {}
+    for policy in results:
+        if policy == reference:
+            continue
+        ci[policy] = {}
+        for load in results[policy]:
+            differences = get_paired_differences(results, policy, reference, load, statistic)
+            ci[policy][load] = stats.confidence_interval(differences, confidence) + (len(differences),)
+    return ci
+
+
+def _get_columns(results, policies):
+    """
+    Columns of the records of the policies in results, one row per record, sorted by policy, load and seed.
+    """
+    records = []
+    for policy in policies:
+        for load in sorted(results.get(policy, {})):
+            records.extend(sorted(results[policy][load], key=lambda r: r['id_simulation']))
+
+    tracked = sorted({obs for record in records for obs in record.get('tracked_results', {})})
+    columns = {
+        'policy': np.array([record['policy'] for record in records], dtype=str),
+        'load': np.array([record['load'] for record in records], dtype=float),
+        'id_simulation': np.array([record['id_simulation'] for record in records], dtype=int),
+        'seed': np.array([record['seed'] for record in records], dtype=int),
+        'request_blocking_ratio': np.array([record['request_blocking_ratio'] for record in records], dtype=float),
+        'average_link_usage': np.array([record['average_link_usage'] for record in records], dtype=float),
+        'network_utilization': np.array([record.get('network_utilization', np.nan) for record in records], dtype=float),
+        'individual_link_usage': np.array([record['individual_link_usage'] for record in records],
+                                          dtype=float).reshape(len(records), -1)
+        if len(records) > 0 else np.zeros((0, 0)),
+    }
+    for obs in tracked:
+        length = max(len(record['tracked_results'].get(obs, [])) for record in records)
+        column = np.full((len(records), length), np.nan)
+        for idx, record in enumerate(records):
+            values = record['tracked_results'].get(obs, [])
+            column[idx, :len(values)] = values
+        columns['tracked_' + obs] = column
+    return columns
+
+
+def save_results(file, results, args=None, policies=None, loads=None, output_folder=None, timedelta=None,
+                 confidence=0.95):
+    """
+    Saves the records as columns of a NumPy .npz file, one row per record, sorted by policy, load and seed.
+    The tracked statistics are stored as 2D arrays padded with NaN. The confidence intervals of the request
+    blocking ratio of each configuration, and the ones of its paired differences to the first policy, are saved
+    with the metadata. The file is not compressed, so that open_results() can map its columns into memory.
+    """
+    policies = list(results) if policies is None else policies
+    columns = _get_columns(results, policies)
+
+    metadata = {
+        'args': vars(args) if args is not None else None,
+        'policies': policies,
+        'loads': loads if loads is not None else sorted({load for policy in results for load in results[policy]}),
+        'output_folder': output_folder,
+        'timedelta': timedelta.total_seconds() if timedelta is not None else None,
+        'datetime': datetime.datetime.now().isoformat(),
+        'confidence': confidence,
+        # JSON keys are strings, therefore the intervals are stored as lists [policy, load, mean, half-width, seeds]
+        'confidence_intervals': [[policy, load, mean, half_width, seeds]
+                                 for policy, per_load in get_confidence_intervals(results, confidence).items()
+                                 for load, (mean, half_width, seeds) in per_load.items()],
+        'paired_confidence_intervals': [[policy, load, mean, half_width, pairs]
+                                        for policy, per_load in get_paired_confidence_intervals(
+                                            {policy: results.get(policy, {}) for policy in policies},
+                                            confidence=confidence).items()
+                                        for load, (mean, half_width, pairs) in per_load.items()],
+    }
+    np.savez(file, metadata=np.array(json.dumps(metadata)), **columns)
+
+
+def load_results(file):
+    """
+    Loads a file saved by save_results(). Returns a dict with the same keys as the former final_results.h5:
+    args, env (rebuilt from args), results (results[policy][load] -> list of records), policies, loads,
+    timedelta and datetime, plus the confidence intervals of the request blocking ratio
+    (confidence_intervals[policy][load] = (mean, half-width, number of seeds)) and of its paired differences to the
+    first policy (paired_confidence_intervals[policy][load] = (mean, half-width, number of pairs)).
+    """
+    with np.load(file) as data:
+        metadata = json.loads(str(data['metadata']))
+        columns = {key: data[key] for key in data.files if key != 'metadata'}
+
+    results = {policy: {} for policy in metadata['policies']}
+    for idx in range(len(columns['policy'])):
+        load = columns['load'][idx]
+        record = {
+            'policy': str(columns['policy'][idx]),
+            'load': int(load) if float(load).is_integer() else float(load),
+            'id_simulation': int(columns['id_simulation'][idx]),
+            'seed': int(columns['seed'][idx]),
+            'request_blocking_ratio': float(columns['request_blocking_ratio'][idx]),
+            'average_link_usage': float(columns['average_link_usage'][idx]),
+            'network_utilization': float(columns['network_utilization'][idx]) if 'network_utilization' in columns else np.nan,
+            'individual_link_usage': list(columns['individual_link_usage'][idx]),
+            'tracked_results': {key[len('tracked_'):]: [x for x in columns[key][idx] if not np.isnan(x)]
+                                for key in columns if key.startswith('tracked_')},
+        }
+        add_record(results, record)
+
+    args = argparse.Namespace(**metadata['args']) if metadata['args'] is not None else None
+    env = core.Environment(args, output_folder=metadata['output_folder'])
+    return {
+        'args': args,
+        'env': env,
+        'results': results,
+        'policies': metadata['policies'],
+        'loads': metadata['loads'],
+        'timedelta': datetime.timedelta(seconds=metadata['timedelta']) if metadata['timedelta'] is not None else None,
+        'datetime': datetime.datetime.fromisoformat(metadata['datetime']),
+        'confidence_intervals': get_confidence_intervals(results, metadata.get('confidence', 0.95)),
+        'paired_confidence_intervals': get_paired_confidence_intervals(results, confidence=metadata.get('confidence', 0.95)),
+    }
+
+
+def _load_column(file, key):
+    """
+    Maps the column key of a file saved by save_results() into memory, so that its values are only read from the
+    disk when accessed. The columns that cannot be mapped (compressed, empty or of objects) are read in full.
+    """
+    with zipfile.ZipFile(file) as archive:
+        info = archive.getinfo(key + '.npy')
+    if info.compress_type == zipfile.ZIP_STORED:
+        with open(file, 'rb') as data:
+            # the local header of the member is followed by its name and extra field, and then by the .npy file
+            data.seek(info.header_offset)
+            name_length, extra_length = struct.unpack('<HH', data.read(30)[26:30])
+            data.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(data)
+            if version in [(1, 0), (2, 0)]:
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else \
+                    np.lib.format.read_array_header_2_0
+                shape, fortran_order, dtype = read_header(data)
+                if not dtype.hasobject and math.prod(shape) > 0:
+                    return np.memmap(file, dtype=dtype, mode='r', shape=shape, order='F' if fortran_order else 'C',
+                                     offset=data.tell())
+    with np.load(file) as data:
+        return data[key]
+
+
+class ResultsTable:
+    """
+    Records of one or several runs as columns with one row per record: the columns saved by save_results(), plus
+    'run', the index of the run of each record in self.runs (with its metadata in self.metadata). The columns are
+    read when first accessed, mapped into memory, and the ones of several runs are concatenated (read by threads
+    threads, if given), with NaN where a run does not have a column or has shorter tracked statistics.
+    """
+    def __init__(self, runs, threads=None):
+        # runs is a list of tuples (name, metadata, number of records, dict column -> function returning its array)
+        self.runs = [name for name, _, _, _ in runs]
+        self.metadata = [metadata for _, metadata, _, _ in runs]
+        self._sizes = [size for _, _, size, _ in runs]
+        self._loaders = [loaders for _, _, _, loaders in runs]
+        self.threads = threads
+        self._columns = {}
+
+    @classmethod
+    def from_files(cls, files, threads=None):
+        """
+        Opens the files saved by save_results(). Only their metadata and policy columns are read.
+        """
+        runs = []
+        for file in files:
+            with zipfile.ZipFile(file) as archive:
+                keys = [name[:-len('.npy')] for name in archive.namelist() if name != 'metadata.npy']
+            with np.load(file) as data:
+                metadata = json.loads(str(data['metadata']))
+            loaders = {key: functools.partial(_load_column, file, key) for key in keys}
+            name = metadata.get('output_folder') or os.path.dirname(file)
+            runs.append((name, metadata, len(loaders['policy']()), loaders))
+        return cls(runs, threads=threads)
+
+    @classmethod
+    def from_results(cls, results, policies=None):
+        """
+        Builds the table of the records in results[policy][load], e.g., the ones received so far by run.py.
+        """
+        columns = _get_columns(results, list(results) if policies is None else policies)
+        loaders = {key: functools.partial(np.asarray, value) for key, value in columns.items()}
+        return cls([('results', None, len(columns['policy']), loaders)])
+
+    @property
+    def columns(self):
+        return ['run'] + sorted({key for loaders in self._loaders for key in loaders})
+
+    def __len__(self):
+        return sum(self._sizes)
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            if column == 'run':
+                self._columns[column] = np.repeat(np.arange(len(self.runs)), self._sizes)
+            elif column not in self.columns:
+                raise KeyError(column)
+            else:
+                load = lambda loaders: loaders[column]() if column in loaders else None
+                if self.threads is not None and len(self._loaders) > 1:
+                    with ThreadPoolExecutor(self.threads) as pool:
+                        parts = list(pool.map(load, self._loaders))
+                else:
+                    parts = [load(loaders) for loaders in self._loaders]
+                self._columns[column] = self._concatenate(parts)
+        return self._columns[column]
+
+    def _concatenate(self, parts):
+        if len(parts) == 1 and parts[0] is not None:
+            return parts[0]  # kept mapped into memory
+        present = [part for part in parts if part is not None]
+        if present[0].dtype.kind == 'U':
+            return np.concatenate([part if part is not None else np.full(size, '')
+                                   for part, size in zip(parts, self._sizes)])
+        if present[0].ndim == 1:
+            return np.concatenate([part if part is not None else np.full(size, np.nan)
+                                   for part, size in zip(parts, self._sizes)])
+        column = np.full((len(self), max(part.shape[1] for part in present)), np.nan)
+        for part, start in zip(parts, np.cumsum(self._sizes) - self._sizes):
+            if part is not None:
+                column[start:start + len(part), :part.shape[1]] = part
+        return column
+
+    def aggregate(self, statistic='request_blocking_ratio', by=('run', 'policy', 'load'), confidence=0.95,
+                  percentiles=(), mask=None):
+        """
+        Aggregates the statistic over the records of each group with the same values of the columns in by, only of
+        the records selected by the boolean array mask if given. Returns a dict of arrays with one row per group,
+        sorted by the columns in by: the columns in by, 'count', 'mean', 'std', 'half_width' (of the confidence
+        interval, as stats.confidence_interval) and 'p<q>' with the percentile q (as numpy.percentile) for each q in
+        percentiles. With a 2D statistic, e.g., a tracked statistic or the individual link usage, each aggregate has
+        one column per element of the statistic, and the NaN values (padding) are left out.
+        """
+        keys = [np.asarray(self[column]) for column in by]
+        values = np.asarray(self[statistic], dtype=float)
+        if mask is not None:
+            keys = [key[mask] for key in keys]
+            values = values[mask]
+        flat = values.ndim == 1
+        values = values[:, None] if flat else values
+        width = values.shape[1]
+
+        # groups numbered in the order of the values of the columns in by
+        codes = [np.unique(key, return_inverse=True)[1].ravel() for key in keys]
+        sizes = [int(code.max()) + 1 if len(code) > 0 else 1 for code in codes]
+        combined = np.ravel_multi_index(codes, sizes) if len(keys) > 0 else np.zeros(len(values), dtype=int)
+        _, first, group = np.unique(combined, return_index=True, return_inverse=True)
+        num_cells = len(first) * width
+
+        # each (group, element of the statistic) is a cell, with the values that are not NaN
+        cell = (group.ravel()[:, None] * width + np.arange(width)).ravel()
+        values = values.ravel()
+        valid = ~np.isnan(values)
+        cell, values = cell[valid], values[valid]
+        count = np.bincount(cell, minlength=num_cells)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.bincount(cell, weights=values, minlength=num_cells) / count
+            std = np.sqrt(np.bincount(cell, weights=(values - mean[cell]) ** 2, minlength=num_cells) / (count - 1))
+            std[count < 2] = np.nan
+            quantiles = {n: stats.t_quantile(1 - (1 - confidence) / 2, n - 1) for n in np.unique(count) if n >= 2}
+            half_width = np.array([quantiles.get(n, np.nan) for n in count]) * std / np.sqrt(count)
+
+        aggregates = {column: key[first] for column, key in zip(by, keys)}
+        aggregates.update(count=count, mean=mean, std=std, half_width=half_width)
+        # percentiles interpolated linearly between the sorted values of each cell
+        ordered = np.append(values[np.lexsort((values, cell))], np.nan)  # the NaN is read by the empty cells
+        starts = np.cumsum(count) - count
+        for q in percentiles:
+            position = q / 100 * np.maximum(count - 1, 0)
+            lower, upper = np.floor(position).astype(int), np.ceil(position).astype(int)
+            low = ordered[np.where(count > 0, starts + lower, len(ordered) - 1)]
+            high = ordered[np.where(count > 0, starts + upper, len(ordered) - 1)]
+            aggregates[f'p{q:g}'] = low + (high - low) * (position - lower)
+        for name in ['count', 'mean', 'std', 'half_width'] + [f'p{q:g}' for q in percentiles]:
+            aggregates[name] = aggregates[name].reshape(len(first), width)
+            if flat:
+                aggregates[name] = aggregates[name][:, 0]
+        return aggregates
+
+
+def open_results(paths, threads=None):
+    """
+    Opens the results of one or several runs as a ResultsTable, given final_results.npz files or folders, e.g.,
+    results/data with one folder per run, from which every final_results.npz inside is included.
+    """
+    paths = [paths] if isinstance(paths, str) else paths
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '**', 'final_results.npz'), recursive=True)))
+        else:
+            files.append(path)
+    return ResultsTable.from_files(files, threads=threads)
+
+
+if __name__ == '__main__':
+    # prints the aggregates of the runs saved in the given files or folders, e.g., python results.py results/data
+    parser = argparse.ArgumentParser(description='Aggregates the results of one or several runs')
+    parser.add_argument('paths', nargs='+', help='final_results.npz files, or folders with runs inside')
+    parser.add_argument('-st', '--statistic', default='request_blocking_ratio',
+                        help='Statistic to be aggregated (default=request_blocking_ratio)')
+    parser.add_argument('--by', nargs='+', default=['run', 'policy', 'load'],
+                        help='Columns that define the groups (default=run policy load)')
+    parser.add_argument('-p', '--percentiles', type=float, nargs='*', default=[5, 50, 95],
+                        help='Percentiles of the statistic (default=5 50 95)')
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help='Confidence level of the confidence intervals (default=0.95)')
+    parser.add_argument('-t', '--threads', type=int, default=None,
+                        help='Number of threads reading the runs (default: one)')
+    args = parser.parse_args()
+
+    table = open_results(args.paths, threads=args.threads)
+    aggregates = table.aggregate(args.statistic, by=args.by, confidence=args.confidence, percentiles=args.percentiles)
+    if aggregates['mean'].ndim > 1:
+        parser.error('Only the statistics with one value per record can be printed')
+    names = [name for name in aggregates if name not in args.by]
+    print('\t'.join(args.by + names))
+    for idx in range(len(aggregates['count'])):
+        keys = [table.runs[aggregates[column][idx]] if column == 'run' else str(aggregates[column][idx])
+                for column in args.by]
+        print('\t'.join(keys + [f'{aggregates[name][idx]:.6g}' for name in names]))
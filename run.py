@@ -2,22 +2,58 @@ import logging
 logging.basicConfig(format='%(asctime)s\t%(name)-12s\t%(threadName)s\t%(message)s', level=logging.DEBUG)
 
 import argparse
-import copy
 import sys
-import pickle
 import datetime
 import time
 import shutil
 import git
 import os
-from multiprocessing import Pool
-from multiprocessing import Manager
+from multiprocessing import Process
+from multiprocessing import Queue
 
 # imports of internal files
+import analytical
 import core
+import executors
 import graph
-import plots
 import policies
+import profiling
+from results import add_record, get_confidence_intervals, get_paired_confidence_intervals, get_paired_differences, \
+    load_records, save_results
+from stats import has_converged
+
+
+def is_task_completed(results, env, seed):
+    """
+    Whether all the records of the seed of the configuration of env are in results, i.e., one record per batch in
+    batch-means mode, or one record otherwise. With common random numbers or a load sweep, env is the list of the
+    environments run together.
+    """
+    if isinstance(env, list):
+        return all(is_task_completed(results, env_p, seed) for env_p in env)
+    ids = {record['id_simulation'] for record in results[env.policy.name][env.load]}
+    if env.num_batches > 0:
+        return all(seed * env.num_batches + batch in ids for batch in range(env.num_batches))
+    return seed in ids
+
+
+def has_configuration_converged(results, env):
+    """
+    Whether the confidence interval of the request blocking ratio of the configuration of env is narrow enough
+    (see --ci_precision). With common random numbers or a load sweep, env is the list of the environments run
+    together, which have all converged. With common random numbers, the intervals of the paired differences of each
+    policy to the first one of its load are used instead.
+    """
+    if isinstance(env, list):
+        references = {}
+        for env_p in env:
+            references.setdefault(env_p.load, env_p.policy.name)
+        return all(has_converged(get_paired_differences(results, env_p.policy.name, references[env_p.load], env_p.load),
+                                 env_p.ci_precision, env_p.min_seeds, env_p.confidence)
+                   if env_p.common_random_numbers and env_p.policy.name != references[env_p.load]
+                   else has_configuration_converged(results, env_p) for env_p in env)
+    return has_converged([r['request_blocking_ratio'] for r in results[env.policy.name][env.load]],
+                         env.ci_precision, env.min_seeds, env.confidence)
 
 
 def run(args):
@@ -27,21 +63,43 @@ def run(args):
     env = core.Environment(args, topology=topology)
 
     logger = logging.getLogger('run')
+    logger.debug('KSP cache: {} hits, {} misses'.format(graph.ksp_cache_stats['hits'], graph.ksp_cache_stats['misses']))
 
     # in this case, a configuration changes only the load of the network
     exec_policies = ['SAP', 'LB']
     loads = [x for x in range(args.min_load, args.max_load + 1, args.load_step)]
 
-    final_output_folder = env.output_folder + '/' + datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S.%fUTC')
+    # the loads whose estimated blocking is negligible or saturated for all the policies are not simulated
+    estimates = None
+    if args.prescreen:
+        estimates = analytical.estimate_loads(env, loads, exec_policies)
+        for policy, per_load in estimates.items():
+            for load, blocking in per_load.items():
+                logger.debug(f'{policy} load {load}: estimated blocking {blocking:.3e}')
+        loads = analytical.get_simulated_loads(estimates, args.prescreen_min_blocking, args.prescreen_max_blocking)
+        if len(loads) == 0:
+            raise ValueError('The estimated blocking of all the loads is outside the --prescreen range')
+        logger.debug(f'Simulating the loads {loads} after the prescreening')
+
+    if args.resume is not None:  # continues the run saved in this folder
+        final_output_folder = args.resume
+        if not os.path.isdir('./results/' + final_output_folder):
+            raise ValueError(f'There is no run to be resumed in ./results/{final_output_folder}')
+    else:
+        final_output_folder = env.output_folder + '/' + datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S.%fUTC')
     env.output_folder = final_output_folder
+    # the record of each simulation is saved in this folder as soon as it is received
+    units_folder = './results/{}/units'.format(env.output_folder)
 
-    if not os.path.isdir('./results/' + env.output_folder):
-        os.makedirs('./results/' + env.output_folder)
+    if not os.path.isdir(units_folder):
+        os.makedirs(units_folder)
         logger.debug(f'creating folder {env.output_folder}')
 
     # copy current version of files
-    with open('./results/{}/0-info.txt'.format(env.output_folder), 'wt') as file:
+    with open('./results/{}/0-info.txt'.format(env.output_folder), 'at' if args.resume is not None else 'wt') as file:
         width = 20
+        if args.resume is not None:
+            print('\nResumed', file=file)
         print('Date (UTC):'.ljust(width), datetime.datetime.now(datetime.timezone.utc), file=file)
         print('Date (local):'.ljust(width), datetime.datetime.now(), file=file)
         repo = git.Repo()
@@ -50,15 +108,19 @@ def run(args):
         print('GIT hexsha:'.ljust(width), repo.head.object.hexsha, file=file)
         print('Command:'.ljust(width), ' '.join(sys.argv), file=file)
         print('Arguments:'.ljust(width), args, file=file)
+        print('KSP cache:'.ljust(width), 'hits={hits}, misses={misses}'.format(**graph.ksp_cache_stats), file=file)
+        if estimates is not None:
+            print('Estimates:'.ljust(width), estimates, file=file)
 
     # copy current version of files
-    shutil.copytree('./', f'./results/{env.output_folder}/source-code/',
-                    ignore=shutil.ignore_patterns('__pycache__', '*.pyc', '*.md', 'results', 'LICENSE', '*.ipynb'))
+    if not os.path.isdir(f'./results/{env.output_folder}/source-code/'):
+        shutil.copytree('./', f'./results/{env.output_folder}/source-code/',
+                        ignore=shutil.ignore_patterns('__pycache__', '*.pyc', '*.md', 'results', 'cache', 'spool', 'LICENSE', '*.ipynb'))
 
-    manager = Manager()
-    results = manager.dict()
-    for policy in exec_policies: # runs the simulations for two policies
-        results[policy] = {load: manager.list() for load in loads}
+    # the records of each seed are streamed by the simulations and aggregated here
+    results = {policy: {load: [] for load in loads} for policy in exec_policies}
+    for record in load_records(units_folder):  # records saved before the run was resumed
+        add_record(results, record)
 
     envs = []
     for policy in exec_policies: # runs the simulations for two policies
@@ -69,36 +131,87 @@ def run(args):
                 policy_instance = policies.LoadBalancing()
             else:
                 raise ValueError('Policy was not configured correctly (value set to {})'.format(policy))
-            env_topology = copy.deepcopy(topology) # makes a deep copy of the topology object
+            # the topology is provided to the simulations by the executor (see executors.py)
+            # in a load sweep, all the loads use the seed of the first one, as they replay the same arrivals
             env_t = core.Environment(args,
-                                     topology=env_topology,
-                                     results=results,
                                      load=load,
                                      policy=policy_instance,
-                                     seed=len(exec_policies) * load,
+                                     seed=len(exec_policies) * (loads[0] if args.load_sweep else load),
                                      output_folder=final_output_folder)
             envs.append(env_t)
             # code for debugging purposes -- it runs without multithreading
             # if load == 400 and policy == 'SAP':
+            #     env_t.set_topology(topology.copy())
+            #     env_t.results = results
             #     core.run_simulation(env_t)
 
-    logger.debug(f'Starting pool of simulators with {args.threads} threads')
     # use the code above to keep updating the final plot as the simulation progresses
-    with Pool(processes=args.threads) as p:
-        result_pool = p.map_async(core.run_simulation, envs)
-        p.close()
-
-        done = False
-        while not done:
-            if result_pool.ready():
-                done = True
+    plot_queue = Queue() if args.progress_plots == 'async' and args.executor == 'local' else None
+    plotting_process = None
+
+    try:
+        with executors.get_executor(args, topology, plot_queue=plot_queue) as executor:
+            # plots (and therefore matplotlib) is imported only after the simulation processes are started
+            import plots
+            if plot_queue is not None:
+                plotting_process = Process(target=plots.plotting_process, args=(plot_queue,))
+                plotting_process.start()
+
+            # each seed is one task, and the tasks expected to take longer are started first
+            # with common random numbers, a task runs all the policies of one load over the same arrivals, and in a
+            # load sweep, all the loads of one policy (or all the configurations, with both)
+            # the tasks whose records were all saved before the run was resumed are skipped
+            if args.common_random_numbers and args.load_sweep:
+                configurations = [envs]
+            elif args.common_random_numbers:
+                configurations = [[env_t for env_t in envs if env_t.load == load] for load in loads]
+            elif args.load_sweep:
+                configurations = [[env_t for env_t in envs if env_t.policy.name == policy] for policy in exec_policies]
             else:
-                time.sleep(args.temporary_plot_every)
-                plots.plot_final_results(env, results, start_time)
+                configurations = envs
+            tasks = [(configuration, seed) for configuration in configurations for seed in range(env.num_seeds)
+                     if not is_task_completed(results, configuration, seed)]
+            if args.engine == 'lockstep':
+                # the lockstep engine runs up to --lockstep_seeds seeds of a configuration in one task
+                chunk = args.lockstep_seeds if args.lockstep_seeds is not None else env.num_seeds
+                seeds = {}
+                for configuration, seed in tasks:
+                    seeds.setdefault(configuration, []).append(seed)
+                tasks = [(configuration, tuple(pending[idx:idx + chunk])) for configuration, pending in seeds.items()
+                         for idx in range(0, len(pending), chunk)]
+            tasks = sorted(tasks, key=core.get_task_cost, reverse=True)
+            profiles = {}  # profiles[(policy, load)], with --profile
+            in_flight = 0
+            expected_records = 0
+            received_records = 0
+            last_plot = time.time()
+            while len(tasks) > 0 or in_flight > 0 or received_records < expected_records:
+                # keeps a few tasks waiting for each worker, and submits new ones as the previous are completed
+                while in_flight < executor.capacity and len(tasks) > 0:
+                    configuration, seed = tasks.pop(0)
+                    if env.ci_precision is not None and has_configuration_converged(results, configuration):
+                        continue  # the confidence interval of this configuration is already narrow enough
+                    executor.submit((configuration, seed))
+                    in_flight += 1
+                received_records += executor.collect_results(results, timeout=.1, units_folder=units_folder)
+                for outcome in executor.get_completed():
+                    expected_records += outcome['records']  # records sent by the task, collected by the executor
+                    if outcome['profile'] is not None:
+                        profiling.add_profile(profiles, outcome['profile'])
+                    in_flight -= 1
+                if time.time() - last_plot > args.temporary_plot_every:
+                    plots.plot_final_results(env, results, start_time)
+                    last_plot = time.time()
+    finally:
+        if plotting_process is not None:
+            plot_queue.put(None)  # finishes the plotting process
+            plotting_process.join()
 
     # if you do not want periodical updates, you can use the following code
-    # with Pool(processes=args.threads) as p:
-    #     p.map(core.run_simulation, envs)
+    # with Pool(processes=args.threads, initializer=core.init_worker,
+    #           initargs=(graph.SharedTopology(topology), None, results_queue)) as p:
+    #     p.map(core.run_simulation_task, [(env_t, seed) for env_t in envs for seed in range(env_t.num_seeds)])
+    #     collect_results(results_queue, results, timeout=0)
     #     p.close()
     #     p.join()
     #     logging.debug("Finished the threads")
@@ -106,21 +219,23 @@ def run(args):
     # consolidating statistics
     plots.plot_final_results(env, results, start_time)
 
-    with open('./results/{}/final_results.h5'.format(env.output_folder), 'wb') as file:
-        realized_results = dict(results)
-        for k1,v1 in results.items():
-            realized_results[k1] = dict(v1);
-            for k2,v2 in results[k1].items():
-                realized_results[k1][k2] = list(v2)
-        pickle.dump({
-            'args': args, # it is always advisable to save your inputs
-            'env': env, # the base environment as well
-            'results': realized_results,
-            'policies': [policy for policy in exec_policies],
-            'loads': loads,
-            'timedelta': datetime.timedelta(seconds=(time.time() - start_time)),
-            'datetime': datetime.datetime.fromtimestamp(time.time())
-        }, file)
+    # it is always advisable to save your inputs, which are saved together with the results
+    save_results('./results/{}/final_results.npz'.format(env.output_folder), results,
+                 args=args, policies=exec_policies, loads=loads, output_folder=env.output_folder,
+                 timedelta=datetime.timedelta(seconds=(time.time() - start_time)), confidence=env.confidence)
+
+    profiling.save_profiles('./results/{}'.format(env.output_folder), profiles)
+
+    for policy, per_load in get_confidence_intervals(results, env.confidence).items():
+        for load, (mean, half_width, seeds) in per_load.items():
+            estimate = f' (estimated {estimates[policy][load]:.3e})' \
+                if estimates is not None and load in estimates[policy] else ''
+            logger.debug(f'{policy} load {load}: blocking {mean:.3e} +/- {half_width:.3e} ({seeds} samples){estimate}')
+    for policy, per_load in get_paired_confidence_intervals(results, reference=exec_policies[0],
+                                                            confidence=env.confidence).items():
+        for load, (mean, half_width, pairs) in per_load.items():
+            logger.debug(f'{policy} - {exec_policies[0]} load {load}: blocking difference {mean:.3e} +/- '
+                         f'{half_width:.3e} ({pairs} pairs)')
 
     logger.debug('Finishing simulation after {}'.format(datetime.timedelta(seconds=(time.time() - start_time))))
 
@@ -147,9 +262,98 @@ if __name__ == '__main__':
                         help='Seed of the random numbers (default={})'.format(env.seed))
     parser.add_argument('-ns', '--num_seeds', type=int, default=env.num_seeds,
                         help='Number of seeds to run for each configuration (default={})'.format(env.num_seeds))
+    parser.add_argument('-ci', '--ci_precision', type=float, default=env.ci_precision,
+                        help='Stops the seeds of a configuration when the half-width of the confidence interval of the '
+                             'request blocking ratio is within this fraction of its mean (default={}, i.e., all seeds '
+                             'are run)'.format(env.ci_precision))
+    parser.add_argument('--min_seeds', type=int, default=env.min_seeds,
+                        help='Minimum number of seeds before stopping a configuration (default={})'.format(env.min_seeds))
+    parser.add_argument('--confidence', type=float, default=env.confidence,
+                        help='Confidence level of the confidence intervals (default={})'.format(env.confidence))
+    parser.add_argument('-wa', '--warmup_arrivals', type=int, default=env.warmup_arrivals,
+                        help='Number of arrivals at the start of each simulation whose statistics are discarded '
+                             '(default={})'.format(env.warmup_arrivals))
+    parser.add_argument('-nb', '--num_batches', type=int, default=env.num_batches,
+                        help='Batch means: splits the arrivals of each simulation into this number of batches, each '
+                             'reported as one sample, e.g., -ns 1 -nb 20 for one long simulation per configuration '
+                             '(default={}, i.e., one sample per simulation)'.format(env.num_batches))
+    parser.add_argument('-crn', '--common_random_numbers', action='store_true',
+                        help='Runs all the policies of each load and seed together over the same arrivals, drawn '
+                             'once, and stops the seeds with --ci_precision based on the paired differences between '
+                             'the policies')
+    parser.add_argument('-sw', '--load_sweep', action='store_true',
+                        help='Runs all the loads of each seed together over the same arrivals, drawn once with the '
+                             'seed of the first load and with the inter-arrival times scaled to each load, which '
+                             'gives a smoother blocking versus load curve')
+    parser.add_argument('-en', '--engine', default=env.engine, choices=['events', 'lockstep'],
+                        help='Runs each seed with its own event queue (events), or the seeds of each configuration '
+                             'together with their link state in NumPy arrays, routing the i-th arrival of all of them '
+                             'at once (lockstep), which gives the same results faster; lockstep requires '
+                             '--service_history off and makes no progress plots (default={})'.format(env.engine))
+    parser.add_argument('--lockstep_seeds', type=int, default=None,
+                        help='Number of seeds of a configuration run together by each task of the lockstep engine '
+                             '(default: all of them)')
+    parser.add_argument('--prescreen', action='store_true',
+                        help='Estimates the blocking of each policy and load with the reduced-load approximation of '
+                             'analytical.py, and only simulates the loads whose estimate is within '
+                             '[--prescreen_min_blocking, --prescreen_max_blocking] for some policy')
+    parser.add_argument('--prescreen_min_blocking', type=float, default=1e-6,
+                        help='Estimated blocking below which a load is not simulated with --prescreen (default=1e-6)')
+    parser.add_argument('--prescreen_max_blocking', type=float, default=0.5,
+                        help='Estimated blocking above which a load is not simulated with --prescreen (default=0.5)')
+    parser.add_argument('-ex', '--executor', default='local', choices=['local', 'spool'],
+                        help='Runs the seeds in a pool of --threads processes (local), or through a folder shared '
+                             'with workers started with python executors.py worker --spool <folder> (spool), in '
+                             'which case about 2 x --threads seeds are queued at a time (default=local)')
+    parser.add_argument('--spool_folder', default='spool',
+                        help='Folder shared by the coordinator and the workers with --executor spool (default=spool)')
+    parser.add_argument('--spool_lease', type=float, default=60.,
+                        help='Seconds after which a seed claimed by a spool worker that stopped renewing its lease '
+                             '(e.g., because it crashed) is queued again for another worker (default=60)')
+    parser.add_argument('-r', '--resume', default=None,
+                        help='Folder inside results of a run to be resumed with the same arguments, e.g., '
+                             'data/20200101T000000.000000UTC: the seeds whose records were saved are not run again')
+    parser.add_argument('--snapshot_every', type=int, default=None,
+                        help='Saves the state of each simulation every this number of arrivals, so that --resume also '
+                             'continues the simulations that were not finished (default: no snapshots)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Measures the time spent in each kind of event, routing, statistics and plots, and the '
+                             'size of the event queue, saved to profile_<policy>_<load>.json in the results folder '
+                             '(not supported with --snapshot_every)')
     te = 5
     parser.add_argument('-te', '--temporary_plot_every', type=int, default=te, #TODO: adjust for your needs
                         help='Time interval for plotting intermediate statistics of the simulation in seconds (default={})'.format(te))
+    parser.add_argument('-kc', '--ksp_cache_folder', default='cache',
+                        help='Folder of the k-shortest-path cache, an empty value disables the cache (default=cache)')
+    parser.add_argument('--rebuild_ksp_cache', action='store_true',
+                        help='Recomputes the k shortest paths and overwrites the cached ones')
+    parser.add_argument('-kw', '--ksp_weight', default=None,
+                        help='Link attribute used as weight in the k-shortest-path computation (default=None, i.e., hops)')
+    parser.add_argument('--ksp_backend', default='networkx', choices=graph.KSP_BACKENDS,
+                        help='Implementation of the k-shortest-path computation: NetworkX, or Yen\'s algorithm on a '
+                             'CSR adjacency built with NumPy (default=networkx)')
+    parser.add_argument('--ksp_disjoint', action='store_true',
+                        help='Computes k link-disjoint paths instead of the k shortest paths')
+    parser.add_argument('--lazy_ksp', type=int, default=None,
+                        help='Computes the paths of each node pair when first used, keeping the ones of this number '
+                             'of pairs (0 keeps all of them) instead of computing all the pairs at start-up, '
+                             'for large topologies (default: all the pairs at start-up, using the cache)')
+    parser.add_argument('-ls', '--link_state', default=env.link_state_mode, choices=['arrays', 'graph'],
+                        help='Storage of the link state: NumPy arrays or NetworkX attributes (default={})'.format(env.link_state_mode))
+    parser.add_argument('-tg', '--traffic', default=env.traffic, choices=['python', 'numpy'],
+                        help='Generation of the arrivals: one at a time with random.Random, or in blocks with '
+                             'numpy.random.Generator (default={})'.format(env.traffic))
+    parser.add_argument('-tm', '--traffic_matrix', default=None,
+                        help='File with the N x N matrix of relative traffic between nodes (.npy, .csv or text), '
+                             'requires --traffic numpy (default: uniform)')
+    parser.add_argument('-u', '--units', default=None,
+                        help='Distribution of the number of units per service, e.g., 1:0.6,2:0.3,4:0.1 (default: 1)')
+    parser.add_argument('-sh', '--service_history', default='off', choices=['memory', 'disk', 'off'],
+                        help='Keeps all the services in memory, writes them to a CSV file per simulation, or keeps '
+                             'only the running ones, using constant memory (default=off)')
+    parser.add_argument('-pp', '--progress_plots', default='async', choices=['sync', 'async', 'off'],
+                        help='Plots the progress of each simulation within the simulation (sync), in a separate '
+                             'process (async), or not at all (off); use plots.py to plot it afterwards (default=async)')
     parser.add_argument('-o', '--output_folder', default=env.output_folder,
                         help='Output folder inside results (default={})'.format(env.output_folder))
     args = parser.parse_args()
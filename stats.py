@@ -0,0 +1,85 @@
+import math
+from statistics import NormalDist
+import numpy as np
+try:
+    from scipy import stats as scipy_stats
+except ImportError:  # scipy is optional, the quantiles are then computed below
+    scipy_stats = None
+
+
+def t_quantile(p, df):
+    """
+    Quantile p of the Student's t distribution with df degrees of freedom, with scipy if available.
+    Otherwise, it is exact for df = 1 and 2, and for larger df the Cornish-Fisher expansion (Abramowitz and Stegun,
+    26.7.5) is refined with Newton's method on the exact distribution function of integer df (26.7.3 and 26.7.4),
+    as the expansion alone is too small for few degrees of freedom at high confidence.
+    """
+    df = int(df)
+    if scipy_stats is not None:
+        return float(scipy_stats.t.ppf(p, df))
+    if df == 1:
+        return math.tan(math.pi * (p - 0.5))
+    if df == 2:
+        return (2 * p - 1) / math.sqrt(2 * p * (1 - p))
+    z = NormalDist().inv_cdf(p)
+    g1 = (z ** 3 + z) / 4
+    g2 = (5 * z ** 5 + 16 * z ** 3 + 3 * z) / 96
+    g3 = (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / 384
+    g4 = (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / 92160
+    t = z + g1 / df + g2 / df ** 2 + g3 / df ** 3 + g4 / df ** 4
+    if df > 1000:
+        return t  # the expansion is accurate, and the exact distribution function needs about df / 2 terms
+    log_density = math.lgamma((df + 1) / 2) - math.lgamma(df / 2) - 0.5 * math.log(df * math.pi)
+    for _ in range(50):
+        density = math.exp(log_density - (df + 1) / 2 * math.log1p(t * t / df))
+        step = (t_cdf(t, df) - p) / density
+        t -= step
+        if abs(step) <= 1e-12 * max(1.0, abs(t)):
+            break
+    return t
+
+
+def t_cdf(t, df):
+    """
+    Distribution function of the Student's t distribution with an integer number df of degrees of freedom, computed
+    exactly with the finite series of Abramowitz and Stegun, 26.7.3 (odd df) and 26.7.4 (even df).
+    """
+    theta = math.atan(t / math.sqrt(df))
+    sin, cos = math.sin(theta), math.cos(theta)
+    if df % 2 == 1:
+        total, term = 0.0, cos
+        for n in range(3, df + 1, 2):  # cos + 2/3 cos^3 + 2*4/(3*5) cos^5 + ... up to cos^(df - 2)
+            total += term
+            term *= cos * cos * (n - 1) / n
+        probability = 2 / math.pi * (theta + sin * total)
+    else:
+        total, term = 0.0, 1.0
+        for n in range(2, df + 1, 2):  # 1 + 1/2 cos^2 + 1*3/(2*4) cos^4 + ... up to cos^(df - 2)
+            total += term
+            term *= cos * cos * (n - 1) / n
+        probability = sin * total
+    return 0.5 + probability / 2  # probability is P(|T| < t) with the sign of t
+
+
+def confidence_interval(values, confidence=0.95):
+    """
+    Returns the mean of the values and the half-width of its confidence interval (NaN with less than two values).
+    """
+    values = np.asarray(values, dtype=float)
+    mean = float(np.mean(values)) if len(values) > 0 else math.nan
+    if len(values) < 2:
+        return mean, math.nan
+    half_width = t_quantile(1 - (1 - confidence) / 2, len(values) - 1) * float(np.std(values, ddof=1)) / math.sqrt(len(values))
+    return mean, half_width
+
+
+def has_converged(values, precision, min_samples=5, confidence=0.95):
+    """
+    Sequential stopping rule: True when at least min_samples values are available and the half-width of the
+    confidence interval is within precision times the mean. Values that are all zero (e.g., no blocking) also
+    converge after min_samples.
+    """
+    if len(values) < max(min_samples, 2):
+        return False
+    mean, half_width = confidence_interval(values, confidence)
+    return half_width <= precision * abs(mean)
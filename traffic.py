@@ -0,0 +1,176 @@
+import numpy as np
+
+
+def get_node_pairs(num_nodes):
+    """
+    Returns the (P x 2) table of ordered node pairs (source, destination), with source != destination,
+    in the order of the node indices.
+    """
+    sources, destinations = np.nonzero(~np.eye(num_nodes, dtype=bool))
+    return np.stack([sources, destinations], axis=1)
+
+
+def load_traffic_matrix(file):
+    """
+    Reads an N x N matrix of relative traffic between nodes (in the order of topology.graph['node_indices']) from
+    a .npy file or from a text file with one row per line. The diagonal is ignored.
+    """
+    if file.endswith('.npy'):
+        return np.load(file)
+    return np.loadtxt(file, delimiter=',' if file.endswith('.csv') else None)
+
+
+def parse_units_distribution(text):
+    """
+    Parses a distribution of the number of units requested by each service, in the format 'units:weight,...',
+    e.g., '1:0.6,2:0.3,4:0.1'. Returns the lists of units and of probabilities.
+    """
+    units, weights = [], []
+    for item in text.split(','):
+        value, weight = item.split(':')
+        units.append(int(value))
+        weights.append(float(weight))
+    weights = np.array(weights) / np.sum(weights)
+    return units, list(weights)
+
+
+class TrafficGenerator:
+    """
+    Generates the arrivals of a simulation in blocks using numpy.random.Generator.
+    Inter-arrival times are exponential with mean mean_inter_arrival_time, holding times are exponential with mean
+    mean_holding_time, the (source, destination) pairs follow the traffic matrix (uniform over all the distinct
+    pairs by default), and the number of units follows (units, unit_probabilities) (always one by default).
+
+    Reproducibility: each of the four quantities is drawn from its own stream spawned from the seed, and each
+    arrival consumes the same amount of random numbers from each stream. Therefore, the i-th arrival depends only on
+    the seed and on the distributions, not on the block size. Inter-arrival times are standard exponentials scaled by
+    the mean, so the same seed gives the same arrival pattern compressed or stretched for different loads.
+    """
+    def __init__(self, num_nodes, seed, mean_inter_arrival_time, mean_holding_time, traffic_matrix=None,
+                 units=None, unit_probabilities=None, block_size=4096):
+        self.mean_inter_arrival_time = mean_inter_arrival_time
+        self.mean_holding_time = mean_holding_time
+        self.block_size = block_size
+
+        self.pairs = get_node_pairs(num_nodes)
+        if traffic_matrix is not None:
+            traffic_matrix = np.asarray(traffic_matrix, dtype=float)
+            if traffic_matrix.shape != (num_nodes, num_nodes):
+                raise ValueError(f'The traffic matrix should be {num_nodes} x {num_nodes}, '
+                                 f'but it is {traffic_matrix.shape}')
+            weights = traffic_matrix[self.pairs[:, 0], self.pairs[:, 1]]
+        else:
+            weights = np.ones(len(self.pairs))
+        self.pair_cdf = np.cumsum(weights) / np.sum(weights)
+
+        self.units = np.array(units if units is not None else [1])
+        self.units_cdf = np.cumsum(unit_probabilities if unit_probabilities is not None else [1.])
+        self.units_cdf /= self.units_cdf[-1]
+
+        streams = np.random.SeedSequence(seed).spawn(4)
+        self.inter_arrival_rng, self.holding_rng, self.pair_rng, self.units_rng = \
+            [np.random.default_rng(stream) for stream in streams]
+        self._buffer = []
+        self._position = 0
+
+    def draw_block(self, size):
+        """
+        Draws the next size arrivals. Returns arrays with the inter-arrival times, holding times, source indices,
+        destination indices and number of units.
+        """
+        inter_arrival_times = self.inter_arrival_rng.standard_exponential(size) * self.mean_inter_arrival_time
+        holding_times = self.holding_rng.standard_exponential(size) * self.mean_holding_time
+        pairs = self.pairs[np.minimum(np.searchsorted(self.pair_cdf, self.pair_rng.random(size), side='right'),
+                                      len(self.pairs) - 1)]
+        units = self.units[np.minimum(np.searchsorted(self.units_cdf, self.units_rng.random(size), side='right'),
+                                      len(self.units) - 1)]
+        return inter_arrival_times, holding_times, pairs[:, 0], pairs[:, 1], units
+
+    def next(self):
+        """
+        Returns the next arrival as a tuple (inter-arrival time, holding time, source index, destination index,
+        number of units), drawing a new block when needed.
+        """
+        if self._position >= len(self._buffer):
+            self._buffer = list(zip(*[array.tolist() for array in self.draw_block(self.block_size)]))
+            self._position = 0
+        self._position += 1
+        return self._buffer[self._position - 1]
+
+
+class PythonTrafficGenerator:
+    """
+    Generates the arrivals one at a time with a random.Random, as the simulator did originally: the inter-arrival
+    and holding times are drawn with expovariate(), the source and destination with choice() until they differ, and
+    the number of units with choices(). Returns the arrivals in the same format as TrafficGenerator.next(), with the
+    nodes given by their index in node_index.
+    """
+    def __init__(self, rng, nodes, node_index, mean_inter_arrival_time, mean_holding_time, units_distribution=None):
+        self.rng = rng
+        self.nodes = nodes
+        self.node_index = node_index
+        self.mean_inter_arrival_time = mean_inter_arrival_time
+        self.mean_holding_time = mean_holding_time
+        self.units_distribution = units_distribution
+
+    def next(self):
+        inter_arrival_time = self.rng.expovariate(1 / self.mean_inter_arrival_time)
+        holding_time = self.rng.expovariate(1 / self.mean_holding_time)
+        destination = source = self.rng.choice(self.nodes)
+        while source == destination:
+            destination = self.rng.choice(self.nodes)
+        number_units = 1
+        if self.units_distribution is not None:
+            number_units = self.rng.choices(self.units_distribution[0], weights=self.units_distribution[1])[0]
+        return inter_arrival_time, holding_time, self.node_index[source], self.node_index[destination], number_units
+
+
+class SharedTrace:
+    """
+    Draws the arrivals of a generator once and replays them to several readers, e.g., one simulation per routing
+    policy (common random numbers). The arrivals already read by all the readers are discarded, so that the memory
+    used depends on how far apart the readers are, not on the number of arrivals.
+    """
+    def __init__(self, generator, num_readers, discard_every=4096):
+        self.generator = generator
+        self.arrivals = []
+        self.offset = 0  # number of arrivals discarded
+        self.positions = [0] * num_readers
+        self.discard_every = discard_every
+
+    def next(self, reader):
+        index = self.positions[reader] - self.offset
+        if index == len(self.arrivals):
+            lowest = min(self.positions) - self.offset
+            if lowest >= self.discard_every:
+                del self.arrivals[:lowest]
+                self.offset += lowest
+                index -= lowest
+            self.arrivals.append(self.generator.next())
+        self.positions[reader] += 1
+        return self.arrivals[index]
+
+    def get_readers(self, scales=None):
+        """
+        Returns one TraceReader per reader, which multiply the inter-arrival times by their scale, if given.
+        """
+        if scales is None:
+            scales = [None] * len(self.positions)
+        return [TraceReader(self, reader, scale) for reader, scale in enumerate(scales)]
+
+
+class TraceReader:
+    """
+    One reader of a SharedTrace, used in place of a traffic generator. If the inter-arrival times are scaled, e.g.,
+    for a trace drawn with mean 1 and replayed at several loads, the other quantities are the same for all readers.
+    """
+    def __init__(self, trace, reader, scale=None):
+        self.trace = trace
+        self.reader = reader
+        self.scale = scale
+
+    def next(self):
+        arrival = self.trace.next(self.reader)
+        if self.scale is None:
+            return arrival
+        return (arrival[0] * self.scale,) + arrival[1:]